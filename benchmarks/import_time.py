@@ -0,0 +1,90 @@
+"""Import-time benchmark for `fairease.udal.udal`.
+
+Imports the module in fresh interpreters, reports the wall-clock time and the
+cumulative import time measured by `python -X importtime`, and checks that
+none of the heavy dependencies of the brokers were imported. Exits with a
+non-zero status on regression, so it can run in CI:
+
+    python benchmarks/import_time.py --runs 10 --max-ms 300
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+MODULE = 'fairease.udal.udal'
+
+
+# Dependencies that must only be imported once a broker needs them.
+HEAVY_MODULES = ['xarray', 'intake', 'SPARQLWrapper', 'requests', 'pandas']
+
+
+def measure_once(module: str) -> dict:
+    code = (
+        'import sys, json\n'
+        f'import {module}\n'
+        f'print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))\n'
+    )
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - start
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    cumulative = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = line[len('import time:'):].split('|')
+        if name.strip() == module:
+            cumulative = int(cum)
+    return {
+        'wall_ms': wall * 1000,
+        'import_ms': cumulative / 1000,
+        'heavy_modules': json.loads(proc.stdout.strip().splitlines()[-1]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default=MODULE)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median import time exceeds this many milliseconds')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    runs = [measure_once(args.module) for _ in range(args.runs)]
+    heavy = sorted(set(m for run in runs for m in run['heavy_modules']))
+    result = {
+        'benchmark': 'import_time',
+        'module': args.module,
+        'runs': args.runs,
+        'wall_ms_median': statistics.median(r['wall_ms'] for r in runs),
+        'import_ms_median': statistics.median(r['import_ms'] for r in runs),
+        'import_ms_min': min(r['import_ms'] for r in runs),
+        'heavy_modules': heavy,
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    failed = False
+    if heavy:
+        print(f'FAIL: heavy modules imported at startup: {", ".join(heavy)}', file=sys.stderr)
+        failed = True
+    if args.max_ms is not None and result['import_ms_median'] > args.max_ms:
+        print(f'FAIL: median import time {result["import_ms_median"]:.1f} ms > {args.max_ms} ms', file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
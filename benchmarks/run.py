@@ -0,0 +1,247 @@
+"""Offline benchmarks of the brokers against local stand-in servers.
+
+For each broker and result size, measures:
+
+- cold latency: a new broker with an empty cache;
+- warm latency: the same query repeated on the same broker and cache;
+- throughput: distinct queries per second through `execute_many` (as run by
+  `UDAL.execute_many`), for each concurrency level;
+- peak memory: the peak of Python allocations during the cold query.
+
+The Argo brokers are measured in each of the `--configurations` given (see
+`CONFIGURATIONS`): with a cache directory, without one, with the cache
+compacted, decoding files in a thread or process pool, and (IDDAS only)
+filtering values by QC flag.
+
+Results are printed, and written with `--output`, as JSON; `--baseline`
+compares them with a previous run:
+
+    python benchmarks/run.py --sizes 10 100 --concurrency 1 4 --output bench.json
+    python benchmarks/run.py --sizes 10 100 --concurrency 1 4 --baseline bench.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from udal.specification import Config
+
+from fairease.udal.batch import execute_many
+from fairease.udal.brokers.beacon import BeaconBroker
+from fairease.udal.brokers.iddas import IDDASBroker
+from fairease.udal.brokers.local import LocalBroker
+from fairease.udal.brokers.wikidata import WikidataBroker
+
+from servers import StandInServer
+
+
+BROKERS = ['local', 'wikidata', 'beacon', 'iddas']
+
+CONFIGURATIONS = {
+    'default': {},
+    'no-cache': {'cache_dir': None},
+    'compact': {'compact_cache': True},
+    'threads': {'executor': 'threads'},
+    'processes': {'executor': 'processes'},
+    'qc-flags': {},
+}
+"""Settings of the configuration objects of the Argo brokers (the others take
+none), on top of a cache directory and API tokens."""
+
+QUERY_PARAMETERS = {
+    'qc-flags': {'qc_flags': ['1', '2']},
+}
+"""Parameters added to the Argo queries in some configurations."""
+
+
+def make_config(cache_dir: str | None, configuration: str = 'default') -> Config:
+    config = Config()
+    config.cache_dir = cache_dir
+    config.api_tokens['beacon'] = 'benchmark'
+    config.api_tokens['blue_cloud'] = 'benchmark'
+    for option, value in CONFIGURATIONS[configuration].items():
+        setattr(config, option, value)
+    return config
+
+
+def configurations(name: str, selected: list) -> list:
+    """The `selected` configurations applying to broker `name`."""
+    if name == 'beacon':
+        # Beacon does not support QC flag filtering
+        return [c for c in selected if c != 'qc-flags']
+    return selected if name == 'iddas' else ['default']
+
+
+def make_broker(name: str, server: StandInServer, cache_dir: str | None, configuration: str = 'default'):
+    if name == 'local':
+        return LocalBroker()
+    if name == 'wikidata':
+        broker = WikidataBroker()
+        broker.sparql_url = f'{server.url}/wikidata/sparql'
+        return broker
+    if name == 'beacon':
+        broker = BeaconBroker(make_config(cache_dir, configuration))
+        broker.api_url = f'{server.url}/api/query'
+        return broker
+    if name == 'iddas':
+        broker = IDDASBroker(make_config(cache_dir, configuration))
+        broker.sparql_url = f'{server.url}/iddas/sparql'
+        broker.base_url = server.url
+        return broker
+    raise ValueError(f'unknown broker "{name}"')
+
+
+def query(name: str, i: int = 0, configuration: str = 'default'):
+    """Query for a broker; distinct `i` give distinct parameters (and cache
+    entries)."""
+    if name == 'local':
+        return 'urn:fairease.eu:udal:example:weekdays', {'lang': ['en', 'fr', 'nl'][i % 3], 'format': 'long'}
+    if name == 'wikidata':
+        return 'urn:fairease.eu:udal:example:months', {'lang': f'l{i}'}
+    day = 1 + i % 28
+    return 'urn:fairease.eu:argo:data', {
+        'parameter': ['temperature', 'salinity'],
+        'startTime': f'2017-01-{day:02d}',
+        'endTime': f'2017-01-{day + 1:02d}',
+        'latitude': 8.432,
+        'longitude': 95.585,
+        **QUERY_PARAMETERS.get(configuration, {}),
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def bench_latency(name: str, server: StandInServer, repeat: int, configuration: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix='fairease-udal-bench-') as cache_dir:
+        broker = make_broker(name, server, cache_dir, configuration)
+        qname, params = query(name, 0, configuration)
+        tracemalloc.start()
+        cold, result = timed(lambda: broker.execute(qname, dict(params)))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        warm = [timed(lambda: broker.execute(qname, dict(params)))[0] for _ in range(repeat)]
+        broker.close()
+    return {
+        'cold_s': cold,
+        'warm_s_median': statistics.median(warm),
+        'warm_s_min': min(warm),
+        'peak_memory_bytes': peak,
+        'metrics': result.metadata.get('metrics'),
+    }
+
+
+def bench_throughput(name: str, server: StandInServer, concurrency: int, queries: int, configuration: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix='fairease-udal-bench-') as cache_dir:
+        broker = make_broker(name, server, cache_dir, configuration)
+        requests = [query(name, i, configuration) for i in range(queries)]
+        elapsed, items = timed(lambda: execute_many(broker, broker.execute, requests, concurrency))
+        broker.close()
+    errors = [repr(item.error) for item in items if not item.ok]
+    return {
+        'concurrency': concurrency,
+        'queries': queries,
+        'elapsed_s': elapsed,
+        'queries_per_s': queries / elapsed if elapsed else None,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def run(args) -> dict:
+    results = []
+    for size in args.sizes:
+        with StandInServer(profiles=size, levels=args.levels, rows=size * 100, latency=args.latency) as server:
+            for name in args.brokers:
+                for configuration in configurations(name, args.configurations):
+                    entry: dict = {'broker': name, 'configuration': configuration, 'size': size}
+                    try:
+                        entry.update(bench_latency(name, server, args.repeat, configuration))
+                        entry['throughput'] = [
+                            bench_throughput(name, server, c, args.queries, configuration)
+                            for c in args.concurrency
+                        ]
+                    except Exception as e:
+                        entry['error'] = repr(e)
+                    print(json.dumps({k: v for k, v in entry.items() if k != 'metrics'}), file=sys.stderr)
+                    results.append(entry)
+    return {
+        'benchmark': 'brokers',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': vars(args),
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict) -> list:
+    """Ratio current/baseline of the latencies and throughputs measured in
+    both runs (lower is better for latencies, higher for throughputs)."""
+    def key(r: dict) -> tuple:
+        return r['broker'], r.get('configuration', 'default'), r['size']
+
+    old = {key(r): r for r in baseline['results']}
+    rows = []
+    for r in current['results']:
+        b = old.get(key(r))
+        if b is None or 'error' in r or 'error' in b:
+            continue
+        row = {
+            'broker': r['broker'],
+            'configuration': r['configuration'],
+            'size': r['size'],
+            'cold_ratio': r['cold_s'] / b['cold_s'],
+            'warm_ratio': r['warm_s_median'] / b['warm_s_median'],
+            'memory_ratio': r['peak_memory_bytes'] / b['peak_memory_bytes'] if b['peak_memory_bytes'] else None,
+        }
+        old_tp = {t['concurrency']: t for t in b.get('throughput', [])}
+        for t in r.get('throughput', []):
+            bt = old_tp.get(t['concurrency'])
+            if bt and bt['queries_per_s'] and t['queries_per_s']:
+                row[f'throughput_ratio_c{t["concurrency"]}'] = t['queries_per_s'] / bt['queries_per_s']
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brokers', nargs='+', choices=BROKERS, default=BROKERS)
+    parser.add_argument('--configurations', nargs='+', choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS),
+                        help='configurations of the Argo brokers')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100],
+                        help='number of Argo profiles (and hundreds of table rows) returned')
+    parser.add_argument('--levels', type=int, default=100, help='levels per synthetic profile')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--queries', type=int, default=8, help='distinct queries per throughput run')
+    parser.add_argument('--repeat', type=int, default=5, help='warm repetitions')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated network latency in seconds')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None, help='compare with the JSON results of a previous run')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(report, json.load(f))
+    output = json.dumps(report, indent=2, default=str)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
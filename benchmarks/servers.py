@@ -0,0 +1,211 @@
+"""Local stand-ins for the remote services used by the brokers.
+
+A single threaded HTTP server plays the part of:
+
+- the Wikidata SPARQL endpoint (`/wikidata/sparql`);
+- the IDDAS SPARQL endpoint (`/iddas/sparql`), listing one distribution per
+  synthetic Argo profile;
+- the Blue-Cloud download API (`/download?platform=...&cycle=...`), serving a
+  ZIP with one synthetic `_prof.nc` file;
+- the Beacon query API (`/api/query`), serving a synthetic NetCDF table.
+
+The amount of data returned is set through the attributes of `StandInServer`,
+and `latency` adds a fixed delay to every response to simulate the network.
+"""
+
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import threading
+import time
+import zipfile
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import xarray as xr
+
+
+JULD_REFERENCE = datetime.date(1950, 1, 1)
+
+
+def synthetic_profile(platform: int, cycle: int, levels: int, seed: int = 0) -> bytes:
+    """NetCDF bytes of an Argo `_prof.nc` file holding one profile."""
+    rng = np.random.default_rng(seed * 100003 + platform * 1009 + cycle)
+    pres = np.sort(rng.uniform(0, 2000, levels)).astype('float32')
+    juld = (datetime.date(2017, 1, 1) - JULD_REFERENCE).days + cycle * 10 + rng.uniform(0, 1)
+    qc = np.full(levels, b'1', dtype='S1')
+    qc[rng.uniform(size=levels) < 0.05] = b'4'
+    # stored as char(N_PROF, N_LEVELS), as in real profile files
+    qc = np.array([qc.tobytes()], dtype=f'S{levels}')
+    ds = xr.Dataset(
+        {
+            'PLATFORM_NUMBER': (('N_PROF',), np.array([str(platform).ljust(8)], dtype='S8')),
+            'CYCLE_NUMBER': (('N_PROF',), np.array([cycle], dtype='int32')),
+            'JULD': (('N_PROF',), np.array([juld]), {
+                'units': 'days since 1950-01-01 00:00:00 UTC',
+                'standard_name': 'time',
+            }),
+            'LATITUDE': (('N_PROF',), np.array([rng.uniform(-60, 60)])),
+            'LONGITUDE': (('N_PROF',), np.array([rng.uniform(-180, 180)])),
+            'PRES': (('N_PROF', 'N_LEVELS'), pres[np.newaxis, :], {'_FillValue': np.float32(99999.0)}),
+            'PRES_QC': (('N_PROF',), qc),
+            'TEMP': (('N_PROF', 'N_LEVELS'), (20 - pres / 100 + rng.normal(0, 0.1, levels)).astype('float32')[np.newaxis, :], {'_FillValue': np.float32(99999.0)}),
+            'TEMP_QC': (('N_PROF',), qc),
+            'PSAL': (('N_PROF', 'N_LEVELS'), (35 + rng.normal(0, 0.1, levels)).astype('float32')[np.newaxis, :], {'_FillValue': np.float32(99999.0)}),
+            'PSAL_QC': (('N_PROF',), qc),
+            # unused variables, as found in real profile files
+            'DOXY': (('N_PROF', 'N_LEVELS'), rng.uniform(150, 250, (1, levels)).astype('float32')),
+            'HISTORY_INSTITUTION': (('N_HISTORY', 'N_PROF'), np.full((4, 1), b'IF', dtype='S2')),
+        },
+    )
+    encoding = {name: {'char_dim_name': 'N_LEVELS'} for name in ('PRES_QC', 'TEMP_QC', 'PSAL_QC')}
+    return ds.to_netcdf(format='NETCDF3_CLASSIC', encoding=encoding)
+
+
+def synthetic_beacon_table(rows: int, seed: int = 0) -> bytes:
+    """NetCDF bytes of a Beacon query result with `rows` observations."""
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        {
+            'TIME': (('obs',), rng.uniform(24472, 24482, rows)),
+            'Depth [meter]': (('obs',), rng.uniform(0, 2000, rows).astype('float32')),
+            'Latitude': (('obs',), rng.uniform(7.9, 8.9, rows)),
+            'Longitude': (('obs',), rng.uniform(95.0, 96.0, rows)),
+            'Temperature [degree_Celsius]': (('obs',), rng.uniform(2, 30, rows).astype('float32')),
+            'Salinity [PSU]': (('obs',), rng.uniform(33, 37, rows).astype('float32')),
+        },
+    )
+    return ds.to_netcdf(format='NETCDF3_64BIT')
+
+
+class StandInServer:
+    """Stand-in HTTP server running in a background thread."""
+
+    def __init__(self, profiles: int = 10, levels: int = 100, rows: int = 10000, latency: float = 0.0):
+        self.profiles = profiles
+        self.levels = levels
+        self.rows = rows
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._payloads: dict = {}
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _payload(self, key, build):
+        with self._lock:
+            if key not in self._payloads:
+                self._payloads[key] = build()
+            return self._payloads[key]
+
+    def platforms(self):
+        """(platform, cycle) of every synthetic profile."""
+        return [(6900000 + i // 50, i % 50 + 1) for i in range(self.profiles)]
+
+    def iddas_bindings(self) -> dict:
+        bindings = []
+        for platform, cycle in self.platforms():
+            url = f'{self.url}/download?platform={platform}&cycle={cycle}'
+            bindings.append({
+                'distribution': {'type': 'uri', 'value': f'{url}#distribution'},
+                'mediaType': {'type': 'literal', 'value': 'application/netcdf'},
+                'downloadURL': {'type': 'uri', 'value': url},
+            })
+        return {'head': {'vars': ['distribution', 'mediaType', 'downloadURL']}, 'results': {'bindings': bindings}}
+
+    def wikidata_bindings(self) -> dict:
+        bindings = []
+        for i in range(self.rows):
+            lang = f'l{i // 12}'
+            ordinal = str(i % 12 + 1)
+            label = {'type': 'literal', 'xml:lang': lang, 'value': f'name-{i}'}
+            bindings.append({
+                'dayOfWeekOrdinal': {'type': 'literal', 'value': ordinal},
+                'dayOfWeekLabel': label,
+                'dayOfWeekLang': {'type': 'literal', 'value': lang},
+                'monthOrdinal': {'type': 'literal', 'value': ordinal},
+                'monthLabel': label,
+                'monthLang': {'type': 'literal', 'value': lang},
+            })
+        return {'head': {'vars': []}, 'results': {'bindings': bindings}}
+
+    def download(self, platform: int, cycle: int) -> bytes:
+        def build():
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as z:
+                z.writestr(f'R{platform}_{cycle:03d}.nc', b'')
+                z.writestr(f'{platform}_prof.nc', synthetic_profile(platform, cycle, self.levels))
+            return buffer.getvalue()
+        return self._payload(('download', platform, cycle, self.levels), build)
+
+
+def _handler(server: StandInServer):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body: bytes, content_type: str):
+            if server.latency:
+                time.sleep(server.latency)
+            with server._lock:
+                server.requests += 1
+                server.bytes_sent += len(body)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _route(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path.endswith('/sparql') or url.path.endswith('/sparql/query'):
+                bindings = server._payload(
+                    (url.path, server.profiles, server.rows),
+                    lambda: json.dumps(
+                        server.wikidata_bindings() if url.path.startswith('/wikidata')
+                        else server.iddas_bindings()
+                    ).encode(),
+                )
+                return self._send(bindings, 'application/sparql-results+json')
+            if url.path == '/download':
+                platform = int(query['platform'][0])
+                cycle = int(query['cycle'][0])
+                return self._send(server.download(platform, cycle), 'application/zip')
+            if url.path == '/api/query':
+                body = server._payload(('beacon', server.rows), lambda: synthetic_beacon_table(server.rows))
+                return self._send(body, 'application/x-netcdf')
+            self.send_error(404)
+
+        def do_GET(self):
+            self._route()
+
+        def do_POST(self):
+            self._read_body()
+            self._route()
+
+    return Handler
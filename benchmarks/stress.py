@@ -0,0 +1,120 @@
+"""Concurrency stress test of the brokers against local stand-in servers.
+
+One broker instance per broker type and configuration (see
+`run.CONFIGURATIONS`) serves many threads at once, from a cold cache, with a
+few distinct queries repeated so that threads contend for the same cache
+files. The run fails (exit status 1) if:
+
+- a query raises;
+- a result differs from the one of the same query run serially on a separate
+  broker and cache, in the default configuration;
+- a query modifies the parameters it is given;
+- partially written files are left in the cache.
+
+    python benchmarks/stress.py --threads 16 --queries 200
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import pathlib
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from run import BROKERS, CONFIGURATIONS, configurations, make_broker, query
+from servers import StandInServer
+
+
+def fingerprint(data) -> str:
+    """Digest of a result independent of the order of its datasets, rows and
+    columns."""
+    digest = hashlib.sha1()
+    if isinstance(data, list):
+        for item in sorted(fingerprint(item) for item in data):
+            digest.update(item.encode())
+    elif hasattr(data, 'data_vars'):
+        for name in sorted(data.variables):
+            values = np.asarray(data[name].values)
+            digest.update(name.encode())
+            digest.update(str(values.shape).encode())
+            digest.update(values.astype(str).tobytes())
+    else:
+        columns = sorted(data.columns)
+        rows = data[columns].astype(str).sort_values(columns)
+        digest.update(rows.to_csv(index=False).encode())
+    return digest.hexdigest()
+
+
+def stress(name: str, server: StandInServer, threads: int, queries: int, distinct: int, configuration: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix='fairease-udal-stress-') as reference_dir, \
+            tempfile.TemporaryDirectory(prefix='fairease-udal-stress-') as cache_dir:
+        reference = make_broker(name, server, reference_dir)
+        expected = {
+            i: fingerprint(reference.execute(*query(name, i, configuration)).data())
+            for i in range(distinct)
+        }
+        reference.close()
+
+        broker = make_broker(name, server, cache_dir, configuration)
+
+        def run(n: int) -> str | None:
+            qname, params = query(name, n % distinct, configuration)
+            original = copy.deepcopy(params)
+            try:
+                result = broker.execute(qname, params)
+            except Exception as e:
+                return f'query {n}: {e!r}'
+            if params != original:
+                return f'query {n}: parameters modified to {params}'
+            if fingerprint(result.data()) != expected[n % distinct]:
+                return f'query {n}: result differs from the serial run'
+            return None
+
+        requests_before = server.requests
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            failures = [f for f in pool.map(run, range(queries)) if f is not None]
+        broker.close()
+        partial = [str(p) for p in pathlib.Path(cache_dir).rglob('*.part')]
+        failures += [f'partial file left: {p}' for p in partial]
+        return {
+            'broker': name,
+            'configuration': configuration,
+            'threads': threads,
+            'queries': queries,
+            'distinct': distinct,
+            'server_requests': server.requests - requests_before,
+            'failures': len(failures),
+            'first_failures': failures[:5],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brokers', nargs='+', choices=BROKERS, default=BROKERS)
+    parser.add_argument('--configurations', nargs='+', choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS),
+                        help='configurations of the Argo brokers')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--distinct', type=int, default=3, help='distinct queries among those run')
+    parser.add_argument('--profiles', type=int, default=20, help='Argo profiles per query')
+    args = parser.parse_args()
+
+    results = []
+    with StandInServer(profiles=args.profiles, levels=50, rows=args.profiles * 100) as server:
+        for name in args.brokers:
+            for configuration in configurations(name, args.configurations):
+                result = stress(name, server, args.threads, args.queries, args.distinct, configuration)
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    print(json.dumps({'benchmark': 'stress', 'results': results}, indent=2))
+    sys.exit(1 if any(r['failures'] for r in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""Helpers for reading Argo profile files."""
+
+import contextlib
+import io
+import threading
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+
+PROFILE_VARIABLES = ['JULD', 'LATITUDE', 'LONGITUDE']
+"""Variables locating each profile in time and space."""
+
+
+INDEX_VARIABLES = ['PLATFORM_NUMBER', 'CYCLE_NUMBER']
+"""Variables identifying each profile, read when present."""
+
+
+LEVEL_VARIABLES = ['PRES', 'TEMP', 'PSAL']
+"""Measured variables supported by the Argo query."""
+
+
+DEFAULT_QC_FLAGS = ['1', '2']
+"""Argo QC flags of good and probably good values."""
+
+
+_NETCDF_LOCK = threading.RLock()
+
+
+def netcdf_lock(engine: str | None) -> Any:
+    """Lock to hold while using a file opened with `engine`: files read by
+    the netCDF-C library (the default engine), which is not thread-safe, are
+    used one at a time in the process, as xarray does not lock it while
+    opening and closing files."""
+    if engine in (None, 'netcdf4'):
+        return _NETCDF_LOCK
+    return contextlib.nullcontext()
+
+
+def open_profile(
+    source: Any,
+    variables: Sequence[str],
+    qc_flags: Sequence[str] | None = None,
+    engine: str | None = None,
+    optional_variables: Sequence[str] = (),
+    keep_qc: bool = False,
+) -> xr.Dataset | None:
+    """Opens an Argo `_prof.nc` file reading only `variables`, the profile
+    location variables and, if present, the profile index variables and
+    `optional_variables`.
+
+    The file is opened without decoding, every other variable is dropped, and
+    CF decoding (including times) is only applied to the remaining ones, which
+    are then loaded into memory so that the file can be closed. If `qc_flags`
+    is given, values whose `<variable>_QC` flag is not in `qc_flags` are
+    masked in the same pass. The QC flags themselves are only returned if
+    `keep_qc` is set.
+
+    Returns `None` if the file lacks any of the requested variables."""
+    names = list(dict.fromkeys(PROFILE_VARIABLES + list(variables)))
+    with netcdf_lock(engine), xr.open_dataset(source, engine=engine, decode_cf=False) as raw:
+        if any(name not in raw.variables for name in names):
+            return None
+        level_names = list(variables) + [
+            name for name in optional_variables
+            if name in raw.variables and name not in names
+        ]
+        names = list(dict.fromkeys(names + level_names + [
+            name for name in INDEX_VARIABLES if name in raw.variables
+        ]))
+        qc_names = [
+            f'{name}_QC' for name in level_names
+            if (qc_flags is not None or keep_qc) and f'{name}_QC' in raw.variables
+        ]
+        subset = raw[names + qc_names].load()
+    if qc_names and qc_flags is not None:
+        subset = mask_qc(subset, qc_names, qc_flags)
+    # QC flags are kept as characters, not concatenated into strings
+    decoded = xr.decode_cf(subset.drop_vars(qc_names))
+    if keep_qc:
+        decoded = decoded.assign({ name: subset[name].astype('S1') for name in qc_names })
+    return decoded
+
+
+def engine_for(payload: bytes) -> str | None:
+    """xarray engine able to open NetCDF `payload` from memory: `scipy` for
+    NetCDF 3, `h5netcdf` for NetCDF 4 (HDF5)."""
+    if payload[:3] == b'CDF':
+        return 'scipy'
+    if payload[:8] == b'\x89HDF\r\n\x1a\n':
+        return 'h5netcdf'
+    return None
+
+
+def read_profile(
+    source: Any,
+    variables: Sequence[str],
+    qc_flags: Sequence[str] | None = None,
+    exact: dict | None = None,
+) -> xr.Dataset | None:
+    """`open_profile` for a file path or the bytes of a file, followed, if
+    `exact` holds the query parameters, by `filter_exact`.
+
+    Defined at module level, with picklable arguments and result, so that it
+    can run in the workers of any executor of `executors`. Returns `None` if
+    the file lacks a requested variable or no profile passes the filter."""
+    engine = None
+    if isinstance(source, bytes):
+        engine = engine_for(source)
+        source = io.BytesIO(source)
+    dataset = open_profile(source, variables, qc_flags, engine)
+    if dataset is not None and exact is not None:
+        dataset = filter_exact(dataset, exact)
+        if dataset.sizes.get('N_PROF', 1) == 0:
+            return None
+    return dataset
+
+
+class MemoryBudget:
+    """Bytes held in memory by one query, bounded by `limit` (unbounded if
+    `None`)."""
+
+    def __init__(self, limit: int | None):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int):
+        with self._lock:
+            if self.limit is not None and self.used + nbytes > self.limit:
+                raise MemoryError(
+                    f'Query result exceeds the memory limit of {self.limit} bytes. '
+                    'Please narrow down your query, raise memory_limit or set cache_dir.'
+                )
+            self.used += nbytes
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.used -= nbytes
+
+
+def mask_qc(
+    dataset: xr.Dataset,
+    qc_names: List[str],
+    qc_flags: Sequence[str],
+    unchecked: Dict[str, np.ndarray] | None = None,
+) -> xr.Dataset:
+    """Replaces values whose QC flag (in `qc_names`) is not in `qc_flags`
+    with their fill value, or NaN if they have none. `unchecked` maps QC
+    names to masks of the values kept whatever their flag."""
+    accepted = np.array([f.encode() for f in qc_flags], dtype='S1')
+    for qc_name in qc_names:
+        name = qc_name[:-len('_QC')]
+        data = dataset[name]
+        good = np.isin(dataset[qc_name].values.astype('S1'), accepted)
+        if unchecked is not None and qc_name in unchecked:
+            good |= unchecked[qc_name]
+        fill = data.attrs.get('_FillValue')
+        values = np.where(good, data.values, fill if fill is not None else np.nan)
+        dataset[name] = data.copy(data=values)
+    return dataset
+
+
+def _fill(dtype: np.dtype) -> Tuple[np.dtype, Any]:
+    """dtype and value used for missing entries of an array of `dtype`."""
+    if dtype.kind in 'SU':
+        return dtype, dtype.type()
+    if dtype.kind == 'O':
+        return dtype, ''
+    if dtype.kind in 'Mm':
+        return dtype, dtype.type('NaT')
+    return np.result_type(dtype, np.float32), np.nan
+
+
+def pack_profiles(datasets: Sequence[xr.Dataset]) -> xr.Dataset:
+    """Packs profiles read by `open_profile` into one dataset of contiguous
+    `N_PROF` (profile-level variables such as platform, cycle, time and
+    position) and `N_PROF` x `N_LEVELS` arrays, allocating each variable
+    once. Profiles with fewer levels, or lacking a variable, are padded with
+    missing values (NaN for numbers)."""
+    if not datasets:
+        return xr.Dataset()
+    names = list(dict.fromkeys(name for ds in datasets for name in ds.data_vars))
+    n_prof = np.array([ds.sizes.get('N_PROF', 1) for ds in datasets])
+    n_levels = [ds.sizes.get('N_LEVELS', 0) for ds in datasets]
+    offsets = np.concatenate([[0], np.cumsum(n_prof)])
+    data_vars = {}
+    for name in names:
+        var = next(ds[name] for ds in datasets if name in ds.data_vars)
+        complete = all(name in ds.data_vars for ds in datasets)
+        if var.dims == ('N_PROF',) and complete:
+            values = np.concatenate([ds[name].values for ds in datasets])
+        elif var.dims == ('N_PROF', 'N_LEVELS') and complete and len(set(n_levels)) == 1:
+            values = np.concatenate([ds[name].values for ds in datasets], axis=0)
+        elif var.dims in (('N_PROF',), ('N_PROF', 'N_LEVELS')):
+            dtype, fill = _fill(var.dtype)
+            shape = (offsets[-1],) if var.dims == ('N_PROF',) else (offsets[-1], max(n_levels))
+            values = np.full(shape, fill, dtype=dtype)
+            for ds, start in zip(datasets, offsets):
+                if name in ds.data_vars:
+                    v = ds[name].values
+                    if v.ndim == 1:
+                        values[start:start + v.shape[0]] = v
+                    else:
+                        values[start:start + v.shape[0], :v.shape[1]] = v
+        else:
+            continue
+        data_vars[name] = (var.dims, values, var.attrs)
+    return xr.Dataset(data_vars)
+
+
+LEVEL_INDEX = 'levelIndex'
+"""Variable of a ragged array giving the level of each observation in its
+profile, added by `to_ragged` on request."""
+
+
+def to_ragged(packed: xr.Dataset, level_index: bool = False) -> xr.Dataset:
+    """Converts packed profiles into a CF contiguous ragged array: the levels
+    holding data are stored one profile after the other along `obs`, and
+    `rowSize` gives the number of levels of each profile. With `level_index`,
+    the level of each observation is kept as `LEVEL_INDEX`."""
+    level_names = [
+        name for name, var in packed.data_vars.items()
+        if var.dims == ('N_PROF', 'N_LEVELS')
+    ]
+    if not level_names:
+        return packed
+    # levels holding data: those with a value in any numeric variable
+    numeric_names = [name for name in level_names if packed[name].dtype.kind == 'f']
+    valid = np.zeros(packed[level_names[0]].shape, dtype=bool)
+    for name in numeric_names:
+        valid |= ~np.isnan(packed[name].values)
+    if not numeric_names:
+        valid[:] = True
+    data_vars = {
+        name: (var.dims, var.values, var.attrs)
+        for name, var in packed.data_vars.items()
+        if var.dims == ('N_PROF',)
+    }
+    data_vars['rowSize'] = (('N_PROF',), valid.sum(axis=1).astype('int32'), {
+        'long_name': 'number of levels in this profile',
+        'sample_dimension': 'obs',
+    })
+    for name in level_names:
+        data_vars[name] = (('obs',), packed[name].values[valid], packed[name].attrs)
+    if level_index:
+        data_vars[LEVEL_INDEX] = (('obs',), np.nonzero(valid)[1].astype('int32'), {
+            'long_name': 'level of the observation in its profile',
+        })
+    return xr.Dataset(data_vars, attrs={'featureType': 'profile'})
+
+
+def from_ragged(ragged: xr.Dataset, n_levels: int | None = None) -> xr.Dataset:
+    """Converts a CF contiguous ragged array back into packed profiles of
+    `N_PROF` x `N_LEVELS` arrays, `n_levels` wide (as wide as the longest
+    profile by default). Observations are put back at their `LEVEL_INDEX` if
+    the ragged array has one, and else at the first levels."""
+    row_size = ragged['rowSize'].values.astype('int64')
+    n_prof = len(row_size)
+    starts = np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype('int64')
+    profile_index = np.repeat(np.arange(n_prof), row_size)
+    if LEVEL_INDEX in ragged:
+        level_index = ragged[LEVEL_INDEX].values.astype('int64')
+    else:
+        level_index = np.arange(int(row_size.sum())) - np.repeat(starts, row_size)
+    if n_levels is None:
+        n_levels = int(level_index.max()) + 1 if level_index.size else 0
+    data_vars = {}
+    for name, var in ragged.data_vars.items():
+        if name in ('rowSize', LEVEL_INDEX):
+            continue
+        if var.dims == ('obs',):
+            dtype, fill = _fill(var.dtype)
+            values = np.full((n_prof, n_levels), fill, dtype=dtype)
+            values[profile_index, level_index] = var.values
+            data_vars[name] = (('N_PROF', 'N_LEVELS'), values, var.attrs)
+        else:
+            data_vars[name] = (var.dims, var.values, var.attrs)
+    return xr.Dataset(data_vars)
+
+
+LAYOUTS = ('datasets', 'profiles', 'ragged')
+"""Layouts of Argo query results: one dataset per profile file, packed
+profiles (`pack_profiles`), or a CF contiguous ragged array (`to_ragged`)."""
+
+
+def arrange(datasets: List[xr.Dataset], layout: str | None) -> Any:
+    """Arranges the profiles of a query result in `layout`."""
+    if layout is None or layout == 'datasets':
+        return datasets
+    if layout == 'profiles':
+        return pack_profiles(datasets)
+    if layout == 'ragged':
+        return to_ragged(pack_profiles(datasets))
+    raise ValueError(f"Layout '{layout}' not supported. Please select one of the following layouts: {', '.join(LAYOUTS)}")
+
+
+DEFAULT_RADIUS = 0.5
+"""Half-width, in degrees, of the area matched around a point by the exact
+filter."""
+
+
+def days_since_1950(date: str) -> float:
+    """ISO 8601 `date` in Argo days since 1950-01-01 (`JULD`)."""
+    delta = np.datetime64(date, 's') - np.datetime64('1950-01-01T00:00:00', 's')
+    return delta / np.timedelta64(1, 'D')
+
+
+def later_than(time: np.ndarray, since: str) -> np.ndarray:
+    """Mask of the times strictly after `since` (ISO 8601). `time` may be
+    decoded (datetime64) or in Argo days since 1950-01-01."""
+    time = np.asarray(time)
+    if np.issubdtype(time.dtype, np.datetime64):
+        return time > np.datetime64(since)
+    return time > days_since_1950(since)
+
+
+def latest_time(time: np.ndarray) -> str | None:
+    """Latest of `time` (decoded, or in Argo days since 1950-01-01) as ISO
+    8601, or `None` if there is none."""
+    time = np.asarray(time).ravel()
+    if np.issubdtype(time.dtype, np.datetime64):
+        time = time[~np.isnat(time)]
+        if time.size == 0:
+            return None
+        latest = time.max()
+    else:
+        time = time[np.isfinite(time)]
+        if time.size == 0:
+            return None
+        latest = np.datetime64('1950-01-01T00:00:00', 's') + np.timedelta64(int(np.ceil(time.max() * 86400)), 's')
+    return str(np.datetime_as_string(latest, unit='s'))
+
+
+def spatiotemporal_mask(latitude: np.ndarray, longitude: np.ndarray, time: np.ndarray, params: dict) -> np.ndarray:
+    """Mask of the positions and times matching exactly the area
+    (`bounding_box`, or `latitude`/`longitude` within `radius` degrees) and
+    the period (`startTime` to `endTime`, inclusive) of the query. `time` may
+    be decoded (datetime64) or in Argo days since 1950-01-01."""
+    mask = np.ones(np.shape(latitude), dtype=bool)
+    if 'bounding_box' in params:
+        bbox = params['bounding_box']
+        mask &= (latitude >= bbox['south']) & (latitude <= bbox['north'])
+        if bbox['west'] <= bbox['east']:
+            mask &= (longitude >= bbox['west']) & (longitude <= bbox['east'])
+        else:
+            # crosses the antimeridian
+            mask &= (longitude >= bbox['west']) | (longitude <= bbox['east'])
+    elif 'latitude' in params and 'longitude' in params:
+        radius = params.get('radius', DEFAULT_RADIUS)
+        mask &= np.abs(latitude - params['latitude']) <= radius
+        mask &= np.abs((longitude - params['longitude'] + 180) % 360 - 180) <= radius
+    is_datetime = np.issubdtype(np.asarray(time).dtype, np.datetime64)
+    if 'startTime' in params:
+        start = np.datetime64(params['startTime']) if is_datetime else days_since_1950(params['startTime'])
+        mask &= time >= start
+    if 'endTime' in params:
+        end = np.datetime64(params['endTime'], 'D') + np.timedelta64(1, 'D')
+        end = end if is_datetime else days_since_1950(str(end))
+        mask &= time < end
+    return mask
+
+
+def filter_exact(
+    dataset: xr.Dataset,
+    params: dict,
+    latitude: str = 'LATITUDE',
+    longitude: str = 'LONGITUDE',
+    time: str = 'JULD',
+) -> xr.Dataset:
+    """Keeps the profiles (or observations) of `dataset` inside the exact
+    area and period of the query, along the dimension of `latitude`."""
+    dim = dataset[latitude].dims[0]
+    mask = spatiotemporal_mask(
+        dataset[latitude].values,
+        dataset[longitude].values,
+        dataset[time].values,
+        params,
+    )
+    if mask.all():
+        return dataset
+    return dataset.isel({dim: np.flatnonzero(mask)})
@@ -0,0 +1,122 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import copy
+import itertools
+import json
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+import weakref
+
+from .broker import Broker
+from .result import Result
+
+
+Request = Tuple[str, dict | None]
+"""A query name and its parameters."""
+
+
+class BatchItem(NamedTuple):
+    """Outcome of one request of a batch: either its result or the error
+    raised while executing it."""
+
+    index: int
+    name: str
+    params: dict | None
+    result: Result | None
+    error: Exception | None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+_semaphores: 'weakref.WeakKeyDictionary[Broker, threading.BoundedSemaphore]' = weakref.WeakKeyDictionary()
+
+_semaphores_lock = threading.Lock()
+
+
+def _semaphore(broker: Broker) -> threading.BoundedSemaphore:
+    """Semaphore limiting the concurrent queries on a broker instance, shared
+    by all the batches using it."""
+    with _semaphores_lock:
+        semaphore = _semaphores.get(broker)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(broker._max_concurrency)
+            _semaphores[broker] = semaphore
+        return semaphore
+
+
+def request_key(name: str, params: dict | None) -> str:
+    """Canonical form of a request: equal for requests with the same query
+    name and parameters, whatever the order of the parameters."""
+    return json.dumps([name, params or {}], sort_keys=True, default=str)
+
+
+def execute_many(
+    broker: Broker,
+    execute: Callable[[str, dict | None], Result],
+    requests: Iterable[Request],
+    max_workers: int | None = None,
+    ordered: bool = True,
+) -> List[BatchItem] | Iterator[BatchItem]:
+    """Executes a batch of requests in a thread pool. Identical requests are
+    executed once and share their result. At most `broker._max_concurrency`
+    requests run at the same time on the broker. Returns the items in input
+    order, or, if `ordered` is false, an iterator yielding them as they
+    complete. The iterator only submits a few requests per worker ahead of
+    those yielded, and holds no result once yielded."""
+    requests = list(requests)
+    unique: Dict[str, List[int]] = {}
+    for i, (name, params) in enumerate(requests):
+        unique.setdefault(request_key(name, params), []).append(i)
+
+    semaphore = _semaphore(broker)
+
+    def run(name: str, params: dict | None) -> Result:
+        with semaphore:
+            # brokers may modify the parameters they are given
+            return execute(name, copy.deepcopy(params))
+
+    workers = max_workers or min(len(unique), broker._max_concurrency) or 1
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='udal-batch')
+    groups = iter(unique.values())
+    futures: Dict[Future, List[int]] = {}
+
+    def submit(count: int | None):
+        for indexes in itertools.islice(groups, count):
+            name, params = requests[indexes[0]]
+            futures[pool.submit(run, name, params)] = indexes
+
+    def items(future: Future, indexes: List[int]) -> List[BatchItem]:
+        error = future.exception()
+        result = future.result() if error is None else None
+        return [
+            BatchItem(i, requests[i][0], requests[i][1], result, error) # type: ignore
+            for i in indexes
+        ]
+
+    if ordered:
+        submit(None)
+        try:
+            results: List[BatchItem | None] = [None] * len(requests)
+            for future, indexes in futures.items():
+                for item in items(future, indexes):
+                    results[item.index] = item
+            return results # type: ignore
+        finally:
+            pool.shutdown(wait=False)
+
+    # started now, not on the first iteration
+    submit(2 * workers)
+
+    def completed() -> Iterator[BatchItem]:
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indexes = futures.pop(future)
+                    submit(1)
+                    yield from items(future, indexes)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return completed()
@@ -1,13 +1,45 @@
 from abc import ABC, abstractmethod
+import functools
+import threading
+from typing import Any
 
 from udal.specification import NamedQueryInfo
 
+from . import executors
+from .metrics import REGISTRY, QueryMetrics
 from .namedqueries import QueryName
 from .result import Result
 
 
 class Broker(ABC):
 
+    _name: str = 'broker'
+
+    # Maximum number of queries run at the same time on one instance by
+    # `UDAL.execute_many`.
+    _max_concurrency: int = 4
+
+    # guards the lazily created attributes of all instances
+    _lazy_lock = threading.Lock()
+
+    # number of queries in progress on the instance, and whether it was
+    # closed while they ran
+    _active: int = 0
+    _closing: bool = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        execute = cls.__dict__.get('execute')
+        if execute is not None and not getattr(execute, '__isabstractmethod__', False):
+            @functools.wraps(execute)
+            def counted(self, *args, **kwargs):
+                self._enter()
+                try:
+                    return execute(self, *args, **kwargs)
+                finally:
+                    self._leave()
+            cls.execute = counted
+
     @property
     @abstractmethod
     def queries(self) -> dict[str, NamedQueryInfo]:
@@ -18,3 +50,66 @@ class Broker(ABC):
     @abstractmethod
     def execute(self, name: QueryName, params: dict | None = None) -> Result:
         pass
+
+    def _metrics(self, name: QueryName) -> QueryMetrics:
+        """New metrics collector for one execution of query `name`."""
+        return QueryMetrics(self._name, name)
+
+    def _executor(self) -> Any:
+        """Executor of the per-file work of this instance, created from its
+        configuration on first use (`None` to run serially)."""
+        with Broker._lazy_lock:
+            if not hasattr(self, '_file_executor'):
+                self._file_executor = executors.create_executor(getattr(self, '_config', None))
+            return self._file_executor
+
+    def _session(self) -> Any:
+        """HTTP session of this instance, pooling the connections of its
+        concurrent queries."""
+        import requests
+        with Broker._lazy_lock:
+            if not hasattr(self, '_http_session'):
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self._max_concurrency, 10))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._http_session = session
+            return self._http_session
+
+    def _enter(self):
+        with Broker._lazy_lock:
+            self._active += 1
+
+    def _leave(self):
+        with Broker._lazy_lock:
+            self._active -= 1
+            idle = self._closing and self._active == 0
+        if idle:
+            self._release()
+
+    def close(self):
+        """Releases the executor and HTTP session of this instance, once the
+        queries in progress on it have completed. They are created again if it
+        is used afterwards."""
+        with Broker._lazy_lock:
+            self._closing = True
+            idle = self._active == 0
+        if idle:
+            self._release()
+
+    def _release(self):
+        with Broker._lazy_lock:
+            if self._active:
+                return
+            executor = self.__dict__.pop('_file_executor', None)
+            session = self.__dict__.pop('_http_session', None)
+        executors.close_executor(executor, getattr(self, '_config', None))
+        if session is not None:
+            session.close()
+
+    def _result(self, query: NamedQueryInfo, data, metrics: QueryMetrics, metadata: dict | None = None) -> Result:
+        """Builds the result of a query, publishing its metrics to the
+        process-wide registry and, with `metadata`, to the result metadata."""
+        metrics.finish()
+        REGISTRY.record(metrics)
+        return Result(query, data, {**(metadata or {}), 'metrics': metrics.as_dict()})
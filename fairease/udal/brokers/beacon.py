@@ -1,6 +1,6 @@
 import datetime
+import io
 from pathlib import Path
-import tempfile
 from typing import List
 import requests
 import os
@@ -9,7 +9,11 @@ import warnings
 
 from udal.specification import Config, NamedQueryInfo
 
+from .. import argo, compaction
 from ..broker import Broker
+from ..config import option
+from ..files import atomic_write, path_lock
+from ..metrics import QueryMetrics
 from ..namedqueries import QueryName, QUERY_NAMES, QUERY_REGISTRY
 from ..result import Result
 
@@ -23,6 +27,10 @@ beaconBrokerQueries: dict[QueryName, NamedQueryInfo] = \
 
 class BeaconBroker(Broker):
 
+    _name = 'beacon'
+
+    _max_concurrency = 2
+
     _config: Config
 
     _queryNames: List[QueryName] = beaconBrokerQueryName
@@ -43,8 +51,14 @@ class BeaconBroker(Broker):
         if not self._config or not self._config.api_tokens['beacon']:
             raise Exception('Please provide a token')
         self.token = self._config.api_tokens['beacon']
+        self.api_url = 'https://beacon-argo.maris.nl/api/query'
+
+    def _execute_argo(self, params: dict, metrics: QueryMetrics, metadata: dict):
+        """Executes the Argo data retrieval process.
 
-    def _execute_argo(self, params: dict):
+        With a `watermark` parameter, only the observations made after the
+        latest one returned by the run that returned it are fetched and
+        returned. The watermark of this run is added to `metadata`."""
         json_params = {
             "query_parameters": [
                 {"column_name": "JULD", "alias": "TIME"},
@@ -69,7 +83,13 @@ class BeaconBroker(Broker):
             if 'pressure' in params['parameter']:
                 json_params['query_parameters'].append({"column_name": "PRES", "alias": "Pressure [dbar]"})
 
+        # Observations up to the watermark were returned by previous runs
+        incremental = 'watermark' in params
+        watermark = params.get('watermark') or {}
+        since = watermark.get('time')
+
         # Process date range
+        time_filter = None
         if 'startTime' in params and 'endTime' in params:
             date_ref = datetime.date(1950, 1, 1)
             start_date = datetime.datetime.strptime(params['startTime'], '%Y-%m-%d').date()
@@ -83,84 +103,152 @@ class BeaconBroker(Broker):
             if max_temporal - min_temporal > 31:
                 raise ValueError(f'The maximum time range is 31 days. Please update your input fields above and run the notebook again. The current range is {max_temporal - min_temporal} days.')
 
-            json_params['filters'].append({"for_query_parameter": "TIME", "min": min_temporal, "max": max_temporal})
+            time_filter = {"for_query_parameter": "TIME", "min": min_temporal, "max": max_temporal}
+
+        if since:
+            # days are whole in the filter, later_than drops the rest
+            min_since = int(argo.days_since_1950(since))
+            if time_filter is None:
+                time_filter = {"for_query_parameter": "TIME", "min": min_since}
+            else:
+                time_filter["min"] = max(time_filter["min"], min_since)
+        if time_filter is not None:
+            json_params['filters'].append(time_filter)
 
         # Latitude and longitude
         # Use a range of 0.5 degrees
         # Otherwise Beacon would search for the exact point
         if 'latitude' in params:
-            min = params['latitude'] - 0.5
-            max = params['latitude'] + 0.5
-            json_params['filters'].append({"for_query_parameter": "Latitude", "min": min, "max": max})
+            min_latitude = params['latitude'] - 0.5
+            max_latitude = params['latitude'] + 0.5
+            json_params['filters'].append({"for_query_parameter": "Latitude", "min": min_latitude, "max": max_latitude})
         if 'longitude' in params:
-            min = params['longitude'] - 0.5
-            max = params['longitude'] + 0.5
-            json_params['filters'].append({"for_query_parameter": "Longitude", "min": min, "max": max})
+            min_longitude = params['longitude'] - 0.5
+            max_longitude = params['longitude'] + 0.5
+            json_params['filters'].append({"for_query_parameter": "Longitude", "min": min_longitude, "max": max_longitude})
 
         # bounding box
-        if 'bounding_box' in params:
-            params.pop('bounding_box')
+        # Beacon cannot filter on it, but the exact filter can after download
+        if 'bounding_box' in params and not params.get('exact'):
             warnings.warn('Bounding box is not implemented')
 
         # Create filename
-        params_str = "_".join(f"[{','.join(map(str, params[key])) if isinstance(params[key], list) else params[key]}]" for key in params.keys())
+        # (the bounding box and exact filter apply after download and do not
+        # change the file)
+        file_params = { k: v for k, v in params.items() if k not in ('bounding_box', 'exact', 'radius', 'watermark') }
+        if since:
+            file_params['since'] = since.replace(':', '')
+        params_str = "_".join(f"[{','.join(map(str, file_params[key])) if isinstance(file_params[key], list) else file_params[key]}]" for key in file_params.keys())
         file_name = f"beacon_argo_{params_str}.nc"
 
-        def request_data(json_params, file_name):
-            response = requests.post(
-                'https://beacon-argo.maris.nl/api/query',
-                json=json_params,
-                headers={'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'},
-                stream=True
-            )
-            response.raise_for_status()
-            with open(dir.joinpath(file_name), 'wb') as file:
+        def request_data(json_params, file, budget: argo.MemoryBudget | None = None):
+            with metrics.stage('download'):
+                response = self._session().post(
+                    self.api_url,
+                    json=json_params,
+                    headers={'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'},
+                    stream=True
+                )
+                response.raise_for_status()
                 for chunk in response.iter_content(chunk_size=1024):
+                    if budget is not None:
+                        budget.reserve(len(chunk))
                     file.write(chunk)
+                    metrics.count('bytes', len(chunk))
+
+        def open_data(source, engine='netcdf4', budget: argo.MemoryBudget | None = None):
+            with metrics.stage('open'), argo.netcdf_lock(engine):
+                data = xr.open_dataset(source, engine=engine)
+                if budget is not None:
+                    # reserve the decoded size before loading it
+                    budget.reserve(data.nbytes)
+                    data.load()
+                data.close()
+            metrics.count('files')
+            return filter_data(data)
+
+        def open_compacted(store, file_name):
+            with metrics.stage('open'):
+                data = compaction.read_table(store, file_name)
+            metrics.count('files')
+            return filter_data(data)
+
+        def filter_data(data):
+            if params.get('exact'):
+                with metrics.stage('filtering'):
+                    data = argo.filter_exact(data, params, 'Latitude', 'Longitude', 'TIME').load()
+            if since:
+                with metrics.stage('filtering'):
+                    mask = argo.later_than(data['TIME'].values, since)
+                    if not mask.all():
+                        data = data.isel({data['TIME'].dims[0]: mask.nonzero()[0]})
+            latest = argo.latest_time(data['TIME'].values)
+            metadata['watermark'] = {**watermark, 'time': max(since or '', latest or '') or None}
+            return data
 
 
         if self._config.cache_dir is None:
-            with tempfile.TemporaryDirectory(prefix='fairease-udal-') as temp_dir:
-                dir = Path(temp_dir).joinpath('data')
-                try:
-                    os.makedirs(dir)
-                except:
-                    pass
-
-                try:
-
-                    if not dir.joinpath(file_name).exists():
-                        request_data(json_params, file_name)
-                        
-                    data = xr.open_dataset(dir.joinpath(file_name), engine='netcdf4')
-                    data.close()
-
-                    return data
-                
-                except requests.RequestException as e:
-                    raise Exception(f'Error: {e}')
-                except Exception as e:
-                    raise Exception(f'Error: {e}')
+            # Without a cache, the data is downloaded to memory and loaded
+            # eagerly, never touching the filesystem
+            budget = argo.MemoryBudget(option(self._config, 'memory_limit'))
+            try:
+                metrics.count('cache_misses')
+                buffer = io.BytesIO()
+                request_data(json_params, buffer, budget)
+
+                if buffer.tell() == 0:
+                    if incremental:
+                        metadata['watermark'] = dict(watermark)
+                        return xr.Dataset()
+                    raise Exception('No data found for the given parameters')
+
+                # the buffer is read in place, without copying the download
+                with buffer.getbuffer() as view:
+                    engine = argo.engine_for(bytes(view[:8]))
+                buffer.seek(0)
+                return open_data(buffer, engine, budget)
+
+            except requests.RequestException as e:
+                raise Exception(f'Error: {e}')
+            except Exception as e:
+                raise Exception(f'Error: {e}')
         else:
             dir = Path(self._config.cache_dir).joinpath('data')
-            try:
-                os.makedirs(dir)
-            except:
-                pass
+            os.makedirs(dir, exist_ok=True)
+            path = dir.joinpath(file_name)
 
-            try:
-                
-                if not dir.joinpath(file_name).exists():
-                    request_data(json_params, file_name)
-                
-                if dir.joinpath(file_name).stat().st_size == 0:
-                    raise Exception('No data found for the given parameters')
+            # Tables compacted into the Zarr store replace the cached files
+            compact = option(self._config, 'compact_cache', False)
+            store = Path(self._config.cache_dir).joinpath('beacon.zarr')
 
-                data = xr.open_dataset(dir.joinpath(file_name), engine='netcdf4')
-                data.close()
+            try:
+                # Concurrent queries for the same file wait for the first one
+                # to download (and compact) it
+                with path_lock(path):
+                    if compact and compaction.has_table(store, file_name):
+                        metrics.count('cache_hits')
+                    else:
+                        if path.exists():
+                            metrics.count('cache_hits')
+                        else:
+                            metrics.count('cache_misses')
+                            with atomic_write(path) as file:
+                                request_data(json_params, file)
+
+                        if path.stat().st_size == 0:
+                            if incremental:
+                                metadata['watermark'] = dict(watermark)
+                                return xr.Dataset()
+                            raise Exception('No data found for the given parameters')
+
+                        if compact:
+                            with metrics.stage('compaction'):
+                                compaction.compact_table(store, file_name, path, 'TIME')
+
+                if compact:
+                    return open_compacted(store, file_name)
+                return open_data(path)
 
-                return data
-                
             except requests.RequestException as e:
                 raise Exception(f'Error: {e}')
             except Exception as e:
@@ -171,7 +259,10 @@ class BeaconBroker(Broker):
         queryParams = params or {}
 
         if name == 'urn:fairease.eu:argo:data':
-            return Result(query, self._execute_argo(queryParams))
+            metrics = self._metrics(name)
+            metadata: dict = {}
+            data = self._execute_argo(queryParams, metrics, metadata)
+            return self._result(query, data, metrics, metadata)
         else:
             if name in QUERY_NAMES:
                 raise Exception(f'unsupported query name "{name}"')
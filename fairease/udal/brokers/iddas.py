@@ -1,21 +1,26 @@
+from functools import partial
 import io
 from numbers import Number
 from pathlib import Path
+import re
 import zipfile
 from SPARQLWrapper import SPARQLWrapper, JSON
-import requests
 import os
-import xarray as xr
-from typing import Any, List, Dict, Union
-import tempfile
-import intake
+from typing import Any, List, Dict, Tuple, Union
 
 from udal.specification import Config, NamedQueryInfo
 
+from .. import argo, compaction, executors
 from ..broker import Broker
+from ..config import option
+from ..files import atomic_write, path_lock
+from ..metrics import QueryMetrics
 from ..namedqueries import QueryName, QUERY_NAMES, QUERY_REGISTRY
 from ..result import Result
 
+# xsd:date or xsd:dateTime, as found in dc:modified
+_ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?)?')
+
 iddasBrokerQueryName: List[QueryName] = [
     'urn:fairease.eu:argo:data',
 ]
@@ -26,6 +31,8 @@ iddasBrokerQueries: dict[QueryName, NamedQueryInfo] = \
 
 class IDDASBroker(Broker):
 
+    _name = 'iddas'
+
     _queryNames: List[QueryName] = iddasBrokerQueryName
     
     _config: Config
@@ -46,12 +53,18 @@ class IDDASBroker(Broker):
                 'salinity': 'PSAL',
                 'pressure': 'PRES'
             }
+        # Names under which each parameter may appear as a measured variable
+        # (schema:variableMeasured) of the IDDAS datasets
+        self.measured_variables = {
+                'temperature': ['TEMP', 'sea_water_temperature'],
+                'salinity': ['PSAL', 'sea_water_salinity'],
+                'pressure': ['PRES', 'sea_water_pressure'],
+            }
         self._config = config
         if not self._config or not self._config.api_tokens['blue_cloud']:
             raise ValueError('Please provide a token')
         self.token = self._config.api_tokens['blue_cloud']
 
-        self.catalog = None
         self.base_url = 'https://data.blue-cloud.org/api'
         self.sparql_url = 'https://fair-ease-iddas.maris.nl/sparql/query'
         self.headers = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'}
@@ -86,6 +99,21 @@ class IDDASBroker(Broker):
             else:
                 raise TypeError(f"Expected parameter to be a string or a list of strings, but got {type(param_value).__name__}.")
 
+            # Only keep datasets measuring every requested variable, so that
+            # profiles without them are neither downloaded nor opened
+            for parameter in ([param_value] if isinstance(param_value, str) else param_value):
+                names = ", ".join(f"'{name.lower()}'" for name in self.measured_variables[parameter])
+                sparql_filter.append(f"""
+                FILTER EXISTS {{
+                    ?dataset schema:variableMeasured [ schema:name ?_variableName ] .
+                    FILTER(LCASE(STR(?_variableName)) IN ({names}))
+                }} .
+            """)
+
+        # interpolated into the query, and possibly sent by remote clients
+        for name in ('startTime', 'endTime'):
+            if name in params and (not isinstance(params[name], str) or not _ISO_DATETIME.fullmatch(params[name])):
+                raise ValueError(f"{name} '{params[name]}' is not an ISO 8601 date or date and time.")
         if 'startTime' in params:
             sparql_filter.append(f"FILTER(BOUND(?startDate) && ?startDate >= '{params['startTime']}'^^xsd:date) .")
         if 'endTime' in params:
@@ -118,6 +146,8 @@ class IDDASBroker(Broker):
             east = params['bounding_box'].get('east')
             south = params['bounding_box'].get('south')
             west = params['bounding_box'].get('west')
+            if not all(isinstance(v, Number) and not isinstance(v, bool) for v in (north, east, south, west)):
+                raise ValueError("Bounding box coordinates must be numbers.")
             sparql_filter.append(
                 f"FILTER(BOUND(?bbox) && geof:sfWithin(?bbox, 'POLYGON (({north} {east}, "
                 f"{north} {west}, {south} {west}, "
@@ -145,9 +175,46 @@ class IDDASBroker(Broker):
 
         return list_distribution
 
-    def _prepare_file_names(self, file_name: str, list_distribution: List[str]) -> List[str]:
+    def _platform_cycle(self, distribution: str) -> str:
+        """Identifies the profile of a distribution by platform and cycle."""
+        return f"platform-{self._extract_query_param(distribution, 'platform')}_cycle-{self._extract_query_param(distribution, 'cycle')}"
+
+    def _requested_variables(self, params: dict) -> List[str]:
+        """Argo variables of the requested parameters."""
+        parameter = params['parameter']
+        if isinstance(parameter, str):
+            return [self.dict_params[parameter]]
+        return [self.dict_params[param] for param in parameter]
+
+    def _qc_flags(self, params: dict) -> List[str] | None:
+        qc_flags = params.get('qc_flags')
+        if isinstance(qc_flags, str):
+            return [qc_flags]
+        return qc_flags
+
+    def _modified(self, results: dict) -> Dict[str, str]:
+        """Last modification time (`dc:modified`) of the distributions which
+        have one."""
+        return {
+            result['distribution']['value'].replace("#distribution", ""): result['modified']['value']
+            for result in results['results']['bindings'] if 'modified' in result
+        }
+
+    def _watermark_filter(self, watermark: Dict[str, Any]) -> str:
+        """SPARQL filter leaving out the datasets not modified since the
+        watermark. Datasets without modification time are kept, and then
+        skipped if already seen."""
+        modified = watermark.get('modified')
+        if not modified:
+            return ""
+        # interpolated into the query, and possibly sent by remote clients
+        if not isinstance(modified, str) or not _ISO_DATETIME.fullmatch(modified):
+            raise ValueError(f"Watermark modification time '{modified}' is not an ISO 8601 date or date and time.")
+        return f"FILTER(!BOUND(?_modified) || STR(?_modified) > '{modified}') ."
+
+    def _prepare_file_names(self, file_name: str, list_distribution: List[str], catalog: str) -> List[str]:
         """Prepares platform cycle and file names from distributions."""
-        if self.catalog == "argo":
+        if catalog == "argo":
             list_plataform_cycle = [
                 f"platform-{self._extract_query_param(dist, 'platform')}_cycle-{self._extract_query_param(dist, 'cycle')}"
                 for dist in list_distribution
@@ -160,22 +227,15 @@ class IDDASBroker(Broker):
 
         raise ValueError("Catalog not supported.")
 
-    def _remove_existing_files(self, list_files: List[str], list_distribution: List[str]):
-        """Removes existing files from the distribution list."""
-        for file in list_files:
-            if os.path.exists(file):
-                for distribution in list_distribution:
-                    if self.catalog == 'argo':
-                        platform_cycle = (
-                            f'platform-{self._extract_query_param(distribution, "platform")}_cycle-'
-                            f'{self._extract_query_param(distribution, "cycle")}'
-                        )
-                        if platform_cycle in file:
-                            list_distribution.remove(distribution)
-                    else : 
-                        raise ValueError("Catalog not supported.")
-                    
-        return list_distribution
+    def _remove_existing_files(self, list_files: List[str], list_distribution: List[str], catalog: str) -> List[str]:
+        """Returns the distributions whose file does not exist yet, given
+        the files of `list_distribution` in the same order."""
+        if catalog != 'argo':
+            raise ValueError("Catalog not supported.")
+        return [
+            distribution for file, distribution in zip(list_files, list_distribution)
+            if not os.path.exists(file)
+        ]
 
     def _create_folder_name(self, params: Dict[str, Any]) -> str:
         """Creates a folder name based on parameters."""
@@ -197,12 +257,22 @@ class IDDASBroker(Broker):
 
         return folder_name_filter.replace(" ", "_").replace(":", "_").replace("-", "_").replace(",", "_")
 
-    def _execute_argo(self, params: dict):
-        """Executes the ARGO data retrieval process."""
-        self.catalog = "argo"
+    def _execute_argo(self, params: dict, metrics: QueryMetrics, metadata: dict):
+        """Executes the ARGO data retrieval process.
+
+        With a `watermark` parameter, only the profiles not seen by, or
+        modified since, the run that returned it are fetched and returned.
+        The watermark of this run is added to `metadata`."""
+        catalog = "argo"
+        layout = params.get('layout', 'datasets')
+        if layout not in argo.LAYOUTS:
+            raise ValueError(f"Layout '{layout}' not supported. Please select one of the following layouts: {', '.join(argo.LAYOUTS)}")
         sparql_filter = self._build_sparql_filter(params)
+        incremental = 'watermark' in params
+        watermark = params.get('watermark') or {}
+        sparql_filter += self._watermark_filter(watermark)
         folder_name_filter = self._create_folder_name(params)
-        file_name = f"iddas_{self.catalog}.nc"
+        file_name = f"iddas_{catalog}.nc"
         query = f"""
         PREFIX dcat: <http://www.w3.org/ns/dcat#>
         PREFIX dc: <http://purl.org/dc/terms/>
@@ -211,10 +281,13 @@ class IDDASBroker(Broker):
         PREFIX geof: <http://www.opengis.net/def/function/geosparql/>
         PREFIX geo: <http://www.opengis.net/ont/geosparql#>
         PREFIX schema: <https://schema.org/>
-        SELECT DISTINCT ?distribution ?mediaType ?downloadURL WHERE {{
+        SELECT DISTINCT ?distribution ?mediaType ?downloadURL (MAX(?_modified) AS ?modified) WHERE {{
             ?dataset a dcat:Dataset ;
                 dc:title ?_title ;
                 dc:description ?description .
+            OPTIONAL {{
+                ?dataset dc:modified ?_modified .
+            }}
             OPTIONAL {{
                 ?dataset dc:temporal [
                     a dc:PeriodOfTime ;
@@ -253,92 +326,233 @@ class IDDASBroker(Broker):
         sparql = SPARQLWrapper(self.sparql_url)
         sparql.setQuery(query)
         sparql.setReturnFormat(JSON)
-        results: dict[Any, Any] = sparql.query().convert() # type: ignore
-
-        def download_and_process_files(dir: Path, file_name: str, list_distribution: List[str], results: dict):
-            list_distribution = self._get_list_distribution(results)
-
-            download_urls = []
+        with metrics.stage('discovery'):
+            results: dict[Any, Any] = sparql.query().convert() # type: ignore
 
-            for result in results['results']['bindings']:
-                if result['downloadURL']['value']:
-                    download_urls.append(result['downloadURL']['value'])
+        def download_and_process_files(dir: Path, file_name: str, list_distribution: List[str], results: dict, changed: List[str]):
+            download_urls = {
+                result['distribution']['value'].replace("#distribution", ""): result['downloadURL']['value']
+                for result in results['results']['bindings']
+            }
 
-            for i, download_url in enumerate(download_urls):
-                list_plataform_cycle = [
-                    f"platform-{self._extract_query_param(dist, 'platform')}_cycle-{self._extract_query_param(dist, 'cycle')}"
-                    for dist in list_distribution
-                ]
-                file_name_temp = f"{file_name.split('.nc')[0]}_{list_plataform_cycle[i]}.nc"
-                
-                header = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/zip'}
-                response = requests.get(download_url, headers=header)
-                with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-                    for file in z.namelist():
-                        if file.endswith('_prof.nc'):
-                            z.extract(file, dir)
-                            os.rename(dir.joinpath(file), dir.joinpath(file_name_temp))
-
-        def do_processing(dataset: xr.Dataset, params: dict):
-            dataset.close()
+            for distribution in list_distribution:
+                download_url = download_urls.get(distribution)
+                if not download_url:
+                    continue
+                file_name_temp = f"{file_name.split('.nc')[0]}_{self._platform_cycle(distribution)}.nc"
+
+                # Files are only downloaded by one query at a time, and only
+                # appear complete. Changed profiles are replaced under the
+                # same lock.
+                with path_lock(dir.joinpath(file_name_temp)):
+                    if dir.joinpath(file_name_temp).exists():
+                        if self._platform_cycle(distribution) not in changed:
+                            continue
+                        dir.joinpath(file_name_temp).unlink()
+                    header = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/zip'}
+                    with metrics.stage('download'):
+                        response = self._session().get(download_url, headers=header)
+                    metrics.count('bytes', len(response.content))
+                    with metrics.stage('extract'):
+                        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+                            for file in z.namelist():
+                                if file.endswith('_prof.nc'):
+                                    with atomic_write(dir.joinpath(file_name_temp)) as target:
+                                        target.write(z.read(file))
+
+        def reader(params: dict):
+            # Files are decoded and filtered by the configured executor
             try:
-                list_data_vars = ['JULD', 'LATITUDE', 'LONGITUDE']
-
-                parameter = params['parameter']
-                if isinstance(parameter, str):
-                    list_data_vars.append(self.dict_params[parameter])
-                elif isinstance(parameter, list):
-                    for param in parameter:
-                        list_data_vars.append(self.dict_params[param])
-
-                dataset = dataset[list_data_vars]
-
-                return dataset
+                return partial(
+                    argo.read_profile,
+                    variables=self._requested_variables(params),
+                    qc_flags=self._qc_flags(params),
+                    exact=params if params.get('exact') else None,
+                )
             except KeyError:
                 return None
-            except Exception as e:
-                raise Exception(f'Error: {e}')
 
-        def process_and_return_datasets(dir: Path, params: dict):
-            ds = []
-            for file in dir.iterdir():
-                dataset = do_processing(xr.open_dataset(file), params)
-                if dataset is not None:
-                    ds.append(dataset)
-    
-            return ds
-        if self._config.cache_dir is None:
-            with tempfile.TemporaryDirectory(prefix='fairease-udal-') as temp_dir:
-                dir = Path(temp_dir).joinpath(folder_name_filter)
+        def process_sources(sources: List[Any], params: dict) -> List[Any]:
+            read = reader(params)
+            if read is None:
+                return []
+            with metrics.stage('open'):
                 try:
-                    os.mkdir(dir)
-                except FileExistsError:
-                    pass
+                    datasets = executors.map_ordered(self._executor(), read, sources)
+                except Exception as e:
+                    raise Exception(f'Error: {e}')
+            metrics.count('files', len(sources))
+            return [dataset for dataset in datasets if dataset is not None]
+
+        def process_and_return_datasets(dir: Path, params: dict, profile_ids: List[str]):
+            # only the files of the query: the folder is shared with other
+            # queries, and their files being written
+            files = [dir.joinpath(f"{file_name.split('.nc')[0]}_{id}.nc") for id in profile_ids]
+            files = [file for file in files if file.exists()]
+            ds = process_sources(files, params)
+
+            with metrics.stage('packing'):
+                return argo.arrange(ds, layout)
+
+        def download_and_process_in_memory(results: dict, list_distribution: List[str], params: dict):
+            # Archives are downloaded and extracted to memory one after the
+            # other, and the profiles of each submitted for decoding as soon
+            # as it is extracted, within the memory limit
+            budget = argo.MemoryBudget(option(self._config, 'memory_limit'))
+            header = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/zip'}
+            selected = set(list_distribution)
+            read = reader(params)
+            if read is None:
+                return argo.arrange([], layout)
+            executor = self._executor()
+            ds = []
+            # bytes extracted and decoding futures of each archive, in order
+            pending: List[Tuple[int, List[Any]]] = []
+
+            def collect(wait: bool):
+                while pending and (wait or all(future.done() for future in pending[0][1])):
+                    extracted, futures = pending.pop(0)
+                    for future in futures:
+                        try:
+                            dataset = future.result()
+                        except Exception as e:
+                            raise Exception(f'Error: {e}')
+                        if dataset is not None:
+                            budget.reserve(dataset.nbytes)
+                            ds.append(dataset)
+                    budget.release(extracted)
 
-                list_distribution = self._get_list_distribution(results)
+            for result in results['results']['bindings']:
+                if result['distribution']['value'].replace("#distribution", "") not in selected:
+                    continue
+                download_url = result['downloadURL']['value']
+                if not download_url:
+                    continue
+                with metrics.stage('download'):
+                    response = self._session().get(download_url, headers=header)
+                content = response.content
+                metrics.count('bytes', len(content))
+                budget.reserve(len(content))
+                with metrics.stage('extract'):
+                    with zipfile.ZipFile(io.BytesIO(content)) as z:
+                        payloads = [z.read(file) for file in z.namelist() if file.endswith('_prof.nc')]
+                extracted = sum(len(payload) for payload in payloads)
+                budget.reserve(extracted)
+                budget.release(len(content))
+                del response, content
+                with metrics.stage('open'):
+                    pending.append((extracted, [executors.submit(executor, read, payload) for payload in payloads]))
+                    collect(wait=False)
+                metrics.count('files', len(payloads))
+                del payloads
+            with metrics.stage('open'):
+                collect(wait=True)
+
+            with metrics.stage('packing'):
+                return argo.arrange(ds, layout)
+
+        def read_compacted(store: Path, profile_ids: List[str], params: dict):
+            try:
+                variables = self._requested_variables(params)
+            except KeyError:
+                return argo.arrange([], layout)
+            select = None
+            if params.get('exact'):
+                def select(profiles):
+                    return argo.spatiotemporal_mask(
+                        profiles['LATITUDE'].values,
+                        profiles['LONGITUDE'].values,
+                        profiles['JULD'].values,
+                        params,
+                    )
+            with metrics.stage('open'):
+                ds = compaction.read_datasets(store, profile_ids, variables, self._qc_flags(params), select)
+            metrics.count('files')
+            with metrics.stage('packing'):
+                return argo.arrange(ds, layout)
+
+        if incremental and not results['results']['bindings']:
+            # nothing modified since the watermark
+            metadata['watermark'] = dict(watermark)
+            return argo.arrange([], layout)
+
+        list_distribution = self._get_list_distribution(results)
+        modified = self._modified(results)
+        seen = set(watermark.get('seen', []))
+        latest = max([watermark.get('modified') or ''] + list(modified.values())) or None
+        # Profiles modified before the new watermark are left out by its
+        # filter, only the others need to be remembered
+        metadata['watermark'] = {
+            **watermark,
+            'modified': latest,
+            'seen': sorted({
+                self._platform_cycle(dist) for dist in list_distribution
+                if dist not in modified or modified[dist] >= latest
+            }),
+        }
+
+        # Profiles modified since the watermark are fetched again, those only
+        # seen are skipped
+        changed: List[str] = []
+        if incremental:
+            changed = [
+                self._platform_cycle(dist) for dist in list_distribution
+                if self._platform_cycle(dist) in seen and watermark.get('modified') and dist in modified
+            ]
+            list_distribution = [
+                dist for dist in list_distribution
+                if self._platform_cycle(dist) not in seen or self._platform_cycle(dist) in changed
+            ]
+            if not list_distribution:
+                return argo.arrange([], layout)
+
+        if self._config.cache_dir is None:
+            metrics.count('cache_misses', len(list_distribution))
 
-                download_and_process_files(dir, file_name, list_distribution, results)
-                return process_and_return_datasets(dir, params)
+            return download_and_process_in_memory(results, list_distribution, params)
 
         else:
             dir = Path(self._config.cache_dir).joinpath(folder_name_filter)
-            try:
-                os.mkdir(dir)
-            except FileExistsError:
-                pass
+            os.makedirs(dir, exist_ok=True)
+
+            total = len(list_distribution)
+            profile_ids = [self._platform_cycle(dist) for dist in list_distribution]
+
+            # Profiles already compacted into the Zarr store are not
+            # downloaded again
+            compact = option(self._config, 'compact_cache', False)
+            store = Path(self._config.cache_dir).joinpath('argo.zarr')
+            if compact:
+                stored = compaction.stored_profile_ids(store)
+                list_distribution = [
+                    dist for dist in list_distribution
+                    if self._platform_cycle(dist) not in stored or self._platform_cycle(dist) in changed
+                ]
 
-            list_distribution = self._get_list_distribution(results)
-            list_files = self._prepare_file_names(str(dir.joinpath(file_name)), list_distribution)
-            list_distribution = self._remove_existing_files(list_files, list_distribution)
+            list_files = self._prepare_file_names(str(dir.joinpath(file_name)), list_distribution, catalog)
+            missing = set(self._remove_existing_files(list_files, list_distribution, catalog))
+            list_distribution = [
+                dist for dist in list_distribution
+                if dist in missing or self._platform_cycle(dist) in changed
+            ]
+            metrics.count('cache_hits', total - len(list_distribution))
+            metrics.count('cache_misses', len(list_distribution))
 
             if list_distribution:
-                download_and_process_files(dir, file_name, list_distribution, results)
+                download_and_process_files(dir, file_name, list_distribution, results, changed)
+
+            if compact:
+                with metrics.stage('compaction'):
+                    compaction.compact_profile_files(store, dir, replace=changed)
+                return read_compacted(store, profile_ids, params)
 
-            return process_and_return_datasets(dir, params)
+            return process_and_return_datasets(dir, params, profile_ids)
 
     def _execute_openeo(self, params: dict):
         """Executes the openeo data retrieval process."""
-        self.catalog = "openeo"
+        # only needed here, and slow to import
+        import intake
+        import pystac
         sparql_filter = self._build_sparql_filter(params)
         query = f"""
         PREFIX dcat: <http://www.w3.org/ns/dcat#>
@@ -402,7 +616,7 @@ class IDDASBroker(Broker):
         catalogs = []
 
         for accessURL in accessURLs:
-            response = requests.get(accessURL)
+            response = self._session().get(accessURL)
 
             if response.status_code != 200:
                 print(f"Error: {response.status_code} - {accessURL}")
@@ -445,7 +659,10 @@ class IDDASBroker(Broker):
         queryParams = params or {}
 
         if name == 'urn:fairease.eu:argo:data':
-            return Result(query, self._execute_argo(queryParams))
+            metrics = self._metrics(name)
+            metadata: dict = {}
+            data = self._execute_argo(queryParams, metrics, metadata)
+            return self._result(query, data, metrics, metadata)
         else:
             if name in QUERY_NAMES:
                 raise Exception(f'unsupported query name "{name}"')
@@ -2,7 +2,10 @@ import pandas as pd
 import pathlib
 from typing import List
 
+from udal.specification import Config
+
 from ..broker import Broker
+from ..metrics import QueryMetrics
 from ..namedqueries import NamedQueryInfo, QueryName, QUERY_NAMES, QUERY_REGISTRY
 from ..result import Result
 
@@ -20,11 +23,15 @@ localBrokerQueries: dict[QueryName, NamedQueryInfo] = \
 
 class LocalBroker(Broker):
 
+    _name = 'local'
+
+    _max_concurrency = 8
+
     _query_names: List[QueryName] = localBrokerQueryNames
 
     _queries: dict[QueryName, NamedQueryInfo] = localBrokerQueries
 
-    def __init__(self):
+    def __init__(self, config: Config | None = None):
         pass
 
     @property
@@ -40,8 +47,17 @@ class LocalBroker(Broker):
         base = pathlib.Path(__file__).parent.parent.parent.parent
         return base.joinpath('test/datasets', filename)
 
-    def _execute_weekdays(self, params: dict):
-        data = pd.read_csv(LocalBroker._testDataSetPath('weekdays.csv'))
+    @staticmethod
+    def _read(filename: str, metrics: QueryMetrics) -> pd.DataFrame:
+        path = LocalBroker._testDataSetPath(filename)
+        with metrics.stage('read'):
+            data = pd.read_csv(path)
+        metrics.count('files')
+        metrics.count('bytes', path.stat().st_size)
+        return data
+
+    def _execute_weekdays(self, params: dict, metrics: QueryMetrics):
+        data = LocalBroker._read('weekdays.csv', metrics)
         if 'lang' in params.keys():
             lang = params['lang']
             if isinstance(lang, str):
@@ -58,8 +74,8 @@ class LocalBroker(Broker):
                 data.drop(columns='name', inplace=True)
         return data
 
-    def _execute_months(self, params: dict):
-        data = pd.read_csv(LocalBroker._testDataSetPath('months.csv'))
+    def _execute_months(self, params: dict, metrics: QueryMetrics):
+        data = LocalBroker._read('months.csv', metrics)
         if 'lang' in params.keys():
             lang = params['lang']
             if isinstance(lang, str):
@@ -68,14 +84,14 @@ class LocalBroker(Broker):
                 data = data.loc[data['lang'].isin(lang)]
         return data
 
-    def _execute_translation(self):
+    def _execute_translation(self, metrics: QueryMetrics):
         # prepare weekday translations
-        weekdays = pd.read_csv(LocalBroker._testDataSetPath('weekdays.csv'))
+        weekdays = LocalBroker._read('weekdays.csv', metrics)
         weekdays = weekdays.filter(items=['lang', 'number', 'name'])
         weekdays = weekdays.pivot(columns='lang', values='name', index='number')
         weekdays = weekdays.rename_axis(None)
         # prepare month translations
-        months = pd.read_csv(LocalBroker._testDataSetPath('months.csv'))
+        months = LocalBroker._read('months.csv', metrics)
         months = months.pivot(columns='lang', values='name', index='number')
         months = months.rename_axis(None)
         # return all translations
@@ -84,12 +100,13 @@ class LocalBroker(Broker):
     def execute(self, name: QueryName, params: dict | None = None) -> Result:
         query = LocalBroker._queries[name]
         queryParams = params or {}
+        metrics = self._metrics(name)
         if name == 'urn:fairease.eu:udal:example:weekdays':
-            return Result(query, self._execute_weekdays(queryParams))
+            return self._result(query, self._execute_weekdays(queryParams, metrics), metrics)
         elif name == 'urn:fairease.eu:udal:example:months':
-            return Result(query, self._execute_months(queryParams))
+            return self._result(query, self._execute_months(queryParams, metrics), metrics)
         elif name == 'urn:fairease.eu:udal:example:translation':
-            return Result(query, self._execute_translation())
+            return self._result(query, self._execute_translation(metrics), metrics)
         else:
             if name in QUERY_NAMES:
                 raise Exception(f'unsupported query name "{name}"')
@@ -0,0 +1,106 @@
+import http.client
+import json
+import socket
+from typing import List
+from urllib.parse import parse_qs, quote, urlsplit
+
+from udal.specification import Config, NamedQueryInfo
+
+from .. import transport
+from ..broker import Broker
+from ..namedqueries import QueryName, QUERY_NAMES, QUERY_REGISTRY
+from ..result import Result
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float | None = None):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class RemoteBroker(Broker):
+    """Broker forwarding queries to a query server (`fairease.udal.server`).
+
+    Connection strings are `udal+http://<host>:<port>` or
+    `udal+unix://<socket path>`, optionally followed by `?broker=<connection
+    string>` to select the broker of the server (its default one otherwise).
+    The server's configuration applies; `timeout` (in seconds) can be set on
+    the local one."""
+
+    _name = 'remote'
+
+    # queries are limited by the server
+    _max_concurrency = 16
+
+    _config: Config | None
+
+    def __init__(self, connectionString: str, config: Config | None = None):
+        self._config = config
+        url = urlsplit(connectionString)
+        self.broker = parse_qs(url.query).get('broker', [None])[0]
+        if url.scheme == 'udal+unix':
+            self.socket_path = url.netloc + url.path
+            self.host = None
+        elif url.scheme == 'udal+http':
+            self.socket_path = None
+            self.host = url.netloc
+        else:
+            raise Exception(f'unsupported connection string "{connectionString}"')
+        self.timeout = getattr(config, 'timeout', None)
+        self._queryNames: List[QueryName] | None = None
+
+    def _connection(self) -> http.client.HTTPConnection:
+        # one connection per request, so that queries can run in parallel
+        if self.socket_path is not None:
+            return _UnixHTTPConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)  # type: ignore
+
+    def _error(self, response: http.client.HTTPResponse) -> Exception:
+        body = response.read()
+        try:
+            return Exception(json.loads(body)['error'])
+        except (ValueError, KeyError):
+            return Exception(f'query server error {response.status}: {body[:200]!r}')
+
+    @property
+    def queryNames(self) -> List[str]:
+        if self._queryNames is None:
+            path = '/queries' if self.broker is None else f'/queries?broker={quote(self.broker, safe="")}'
+            connection = self._connection()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise self._error(response)
+                self._queryNames = json.loads(response.read())
+            finally:
+                connection.close()
+        return list(self._queryNames)  # type: ignore
+
+    @property
+    def queries(self):
+        return { k: v for k, v in QUERY_REGISTRY.items() if k in self.queryNames }
+
+    def execute(self, name: QueryName, params: dict | None = None) -> Result:
+        if name not in QUERY_NAMES:
+            raise Exception(f'unknown query name "{name}"')
+        body = json.dumps({'broker': self.broker, 'name': name, 'params': params or {}}, default=str)
+        connection = self._connection()
+        try:
+            connection.request('POST', '/execute', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            if response.status != 200:
+                raise self._error(response)
+            # decoded while it is received
+            metadata, data = transport.read_response(response.getheader(transport.FORMAT_HEADER, 'json'), response)
+        finally:
+            connection.close()
+        metadata['server'] = self.host or self.socket_path
+        return Result(QUERY_REGISTRY[name], data, metadata)
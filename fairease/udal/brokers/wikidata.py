@@ -1,11 +1,12 @@
+import json
 import pandas as pd
 from SPARQLWrapper import SPARQLWrapper, JSON
-import typing
 from typing import List
 
-from udal.specification import NamedQueryInfo
+from udal.specification import Config, NamedQueryInfo
 
 from ..broker import Broker
+from ..metrics import QueryMetrics
 from ..namedqueries import QueryName, QUERY_NAMES, QUERY_REGISTRY
 from ..result import Result
 
@@ -22,12 +23,19 @@ wikidataBrokerQueries: dict[QueryName, NamedQueryInfo] = \
 
 class WikidataBroker(Broker):
 
+    _name = 'wikidata'
+
+    _max_concurrency = 2
+
     _WIKIDATA_SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
 
     _queryNames: List[QueryName] = wikidataBrokerQueryNames
 
     _queries: dict[QueryName, NamedQueryInfo] = wikidataBrokerQueries
 
+    def __init__(self, config: Config | None = None):
+        self.sparql_url = WikidataBroker._WIKIDATA_SPARQL_ENDPOINT
+
     @property
     def queryNames(self) -> List[str]:
         return list(WikidataBroker._queryNames)
@@ -42,7 +50,18 @@ class WikidataBroker(Broker):
             return f'(langMatches(lang(?{var}), "{lang}"))'
         return f'FILTER (' + ' || '.join(list(map(filterExpr, langs))) + ')'
 
-    def _execute_weekdays(self, params: dict):
+    def _query(self, q: str, metrics: QueryMetrics) -> pd.DataFrame:
+        sparql = SPARQLWrapper(self.sparql_url)
+        sparql.setQuery(q)
+        sparql.setReturnFormat(JSON)
+        with metrics.stage('sparql'):
+            body = sparql.query().response.read()
+        metrics.count('bytes', len(body))
+        with metrics.stage('processing'):
+            sparqlResults = json.loads(body)
+            return pd.json_normalize(sparqlResults['results']['bindings'])
+
+    def _execute_weekdays(self, params: dict, metrics: QueryMetrics):
         sparqlFilter = ''
         if 'lang' in params.keys():
             lang = params['lang']
@@ -75,11 +94,7 @@ class WikidataBroker(Broker):
             }
             ORDER BY ?dayOfWeekLang ?dayOfWeekOrdinal
         """
-        sparql = SPARQLWrapper(WikidataBroker._WIKIDATA_SPARQL_ENDPOINT)
-        sparql.setQuery(q)
-        sparql.setReturnFormat(JSON)
-        sparqlResults = typing.cast(dict, sparql.queryAndConvert())
-        data = pd.json_normalize(sparqlResults['results']['bindings'])
+        data = self._query(q, metrics)
         data = data.filter(items=[
             'dayOfWeekOrdinal.value',
             'dayOfWeekLabel.value',
@@ -92,7 +107,7 @@ class WikidataBroker(Broker):
             })
         return data
 
-    def _execute_months(self, params: dict):
+    def _execute_months(self, params: dict, metrics: QueryMetrics):
         sparqlFilter = ''
         if 'lang' in params.keys():
             lang = params['lang']
@@ -123,11 +138,7 @@ class WikidataBroker(Broker):
                 """ + sparqlFilter + """
             }
         """
-        sparql = SPARQLWrapper(WikidataBroker._WIKIDATA_SPARQL_ENDPOINT)
-        sparql.setQuery(q)
-        sparql.setReturnFormat(JSON)
-        sparqlResults = typing.cast(dict, sparql.queryAndConvert())
-        data = pd.json_normalize(sparqlResults['results']['bindings'])
+        data = self._query(q, metrics)
         data = data.filter(items=[
             'monthOrdinal.value',
             'monthLabel.value',
@@ -143,10 +154,11 @@ class WikidataBroker(Broker):
     def execute(self, name: QueryName, params: dict|None = None) -> Result:
         query = WikidataBroker._queries[name]
         queryParams = params or {}
+        metrics = self._metrics(name)
         if name == 'urn:fairease.eu:udal:example:weekdays':
-            return Result(query, self._execute_weekdays(queryParams))
+            return self._result(query, self._execute_weekdays(queryParams, metrics), metrics)
         elif name == 'urn:fairease.eu:udal:example:months':
-            return Result(query, self._execute_months(queryParams))
+            return self._result(query, self._execute_months(queryParams, metrics), metrics)
         else:
             if name in QUERY_NAMES:
                 raise Exception(f'unsupported query name "{name}"')
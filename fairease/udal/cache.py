@@ -0,0 +1,211 @@
+"""Cache of query results at the UDAL layer, whatever the broker.
+
+Results are cached per connection string, configuration, query name and
+canonical parameters, for the time given by `namedqueries.QUERY_TTL` (queries without
+a TTL, or with a parameter of `namedqueries.UNCACHED_PARAMETERS`, are not
+cached). The cache has two tiers:
+
+- an in-memory LRU of at most `result_cache_size` results and
+  `result_cache_bytes` bytes of data (estimated);
+- if the configuration has a `cache_dir`, pickled results in its `results`
+  directory, shared between processes. Files are dated with their expiry
+  time, and expired files are deleted as new results are stored.
+
+It is enabled by setting `result_cache` to `True` on the configuration
+object. Cached results are returned with `metadata['cache']` set to `memory`
+or `disk`. Their data is shared with the cached copy and should not be
+modified in place.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import pickle
+import threading
+import time
+from typing import Any, Dict, Tuple
+
+from udal.specification import Config
+
+from .batch import request_key
+from .config import option
+from .files import atomic_write
+from .namedqueries import QUERY_TTL, UNCACHED_PARAMETERS
+from .registry import config_key
+from .result import Result
+
+
+DEFAULT_SIZE = 256
+"""Results held in memory by default."""
+
+DEFAULT_BYTES = 1 << 30
+"""Bytes of results held in memory by default."""
+
+PRUNE_INTERVAL = 600
+"""Minimum seconds between two scans of the disk tier for expired files."""
+
+
+def _loaded(data: Any) -> Any:
+    """`data` with lazily loaded arrays read, so that it does not depend on
+    files which may later be removed."""
+    if isinstance(data, list):
+        return [_loaded(item) for item in data]
+    if hasattr(data, 'data_vars'):
+        return data.load()
+    return data
+
+
+def _nbytes(data: Any) -> int:
+    """Estimated memory held by `data`."""
+    if isinstance(data, list):
+        return sum(_nbytes(item) for item in data)
+    if hasattr(data, 'data_vars'):
+        return int(data.nbytes)
+    if hasattr(data, 'memory_usage'):
+        return int(data.memory_usage(deep=True).sum())
+    try:
+        return len(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class ResultCache:
+
+    def __init__(self, size: int = DEFAULT_SIZE, directory: Path | str | None = None, max_bytes: int = DEFAULT_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory is not None else None
+        self._entries: 'OrderedDict[str, Tuple[float, Result, int]]' = OrderedDict()
+        self._bytes = 0
+        self._pruned = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(connectionString: str | None, config: Config | None, name: str, params: dict | None) -> str:
+        # the configuration (tokens, endpoints, settings) is hashed so that it
+        # is not written to the disk tier
+        configuration = hashlib.sha256(repr(config_key(config)).encode()).hexdigest()
+        return f'{connectionString}\n{configuration}\n{request_key(name, params)}'
+
+    def _path(self, key: str) -> Path:
+        return self.directory.joinpath(hashlib.sha256(key.encode()).hexdigest() + '.pickle')  # type: ignore
+
+    @staticmethod
+    def _copy(result: Result, tier: str) -> Result:
+        return Result(result.query, result.data(), {**result.metadata, 'cache': tier})
+
+    def get(self, key: str) -> Result | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return self._copy(entry[1], 'memory')
+                self._forget(key)
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                expires, stored_key, result = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated or from an incompatible version
+            path.unlink(missing_ok=True)
+            return None
+        if stored_key != key:
+            return None
+        if expires <= now:
+            path.unlink(missing_ok=True)
+            return None
+        self._remember(key, expires, result)
+        return self._copy(result, 'disk')
+
+    def _forget(self, key: str):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def _remember(self, key: str, expires: float, result: Result):
+        nbytes = _nbytes(result.data())
+        with self._lock:
+            if key in self._entries:
+                self._forget(key)
+            # results larger than the whole memory tier are only on disk
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (expires, result, nbytes)
+            self._bytes += nbytes
+            while len(self._entries) > self.size or self._bytes > self.max_bytes:
+                self._forget(next(iter(self._entries)))
+
+    def put(self, key: str, result: Result, ttl: float):
+        expires = time.time() + ttl
+        result = Result(result.query, _loaded(result.data()), dict(result.metadata))
+        self._remember(key, expires, result)
+        if self.directory is not None:
+            path = self._path(key)
+            with atomic_write(path) as file:
+                pickle.dump((expires, key, result), file, protocol=pickle.HIGHEST_PROTOCOL)
+            # dated with its expiry, for `prune`
+            os.utime(path, (expires, expires))
+            self.prune()
+
+    def prune(self, force: bool = False):
+        """Deletes the expired files of the disk tier, at most every
+        `PRUNE_INTERVAL` seconds unless `force` is set."""
+        if self.directory is None:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._pruned < PRUNE_INTERVAL:
+                return
+            self._pruned = now
+        for path in self.directory.glob('*.pickle'):
+            try:
+                if path.stat().st_mtime <= now:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Drops the results held in memory."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_caches: Dict[Tuple[int, int, str | None], ResultCache] = {}
+
+_caches_lock = threading.Lock()
+
+
+def result_cache(config: Config | None) -> ResultCache | None:
+    """Result cache enabled by the configuration, shared by all the `UDAL`
+    objects with the same cache settings, or `None`."""
+    if not option(config, 'result_cache', False):
+        return None
+    size = option(config, 'result_cache_size', DEFAULT_SIZE)
+    max_bytes = option(config, 'result_cache_bytes', DEFAULT_BYTES)
+    cache_dir = getattr(config, 'cache_dir', None)
+    directory = str(Path(cache_dir).joinpath('results')) if cache_dir is not None else None
+    with _caches_lock:
+        key = (size, max_bytes, directory)
+        if key not in _caches:
+            _caches[key] = ResultCache(size, directory, max_bytes)
+        return _caches[key]
+
+
+def execute(cache: ResultCache, connectionString: str | None, config: Config | None, execute, name: str, params: dict | None) -> Result:
+    """Result of the query from `cache`, or from `execute` then cached if the
+    query has a TTL."""
+    ttl = QUERY_TTL.get(name)  # type: ignore
+    if not ttl or any(parameter in (params or {}) for parameter in UNCACHED_PARAMETERS):
+        return execute(name, params)
+    key = cache.key(connectionString, config, name, params)
+    result = cache.get(key)
+    if result is None:
+        result = execute(name, params)
+        cache.put(key, result, ttl)
+    return result
@@ -0,0 +1,315 @@
+"""Compaction of cached Argo data into consolidated Zarr stores.
+
+Profiles are appended to a store holding two groups: `profiles`, with one
+entry per profile (identifier, platform, cycle, time, position, and the
+`rowStart`/`rowSize` of its levels), and `levels`, with the levels of all the
+profiles one after the other along `obs`, as in a CF contiguous ragged array.
+Each batch of profiles is sorted by time before being appended, so chunks
+cover consecutive periods. Arrays are compressed with the Zarr default
+compressor.
+
+The store also records what is needed to read back the profiles of each file
+as `argo.open_profile` would: the position of each profile in its file
+(`profileIndex`), the number of levels of the file (`nLevels`), the variables
+the file holds (`variableFlags`) and the level of each observation
+(`levelIndex`).
+"""
+
+import hashlib
+from pathlib import Path
+import re
+import shutil
+from typing import Callable, List, Sequence, Set
+
+import numpy as np
+import xarray as xr
+
+from . import argo
+from .files import path_lock
+
+
+PROFILES_GROUP = 'profiles'
+
+LEVELS_GROUP = 'levels'
+
+PROFILE_CHUNK = 4096
+"""Profiles per chunk of the `profiles` group."""
+
+LEVEL_CHUNK = 1 << 18
+"""Levels per chunk of the `levels` group."""
+
+
+_LEVEL_SCHEMA = argo.LEVEL_VARIABLES + [f'{name}_QC' for name in argo.LEVEL_VARIABLES]
+
+_FLAGGED = argo.INDEX_VARIABLES + _LEVEL_SCHEMA
+"""Variables which profile files may lack, flagged in `variableFlags`."""
+
+_BOOKKEEPING = ['PROFILE_ID', 'profileIndex', 'nLevels', 'variableFlags']
+
+store_lock = path_lock
+"""Lock serializing writes to a store within the process."""
+
+
+def _exists(store: Path, group: str) -> bool:
+    return Path(store).joinpath(group).is_dir()
+
+
+def _open(store: Path, group: str) -> xr.Dataset:
+    return xr.open_zarr(store, group=group, consolidated=True)
+
+
+def stored_profile_ids(store: Path) -> Set[str]:
+    """Identifiers of the profiles held in a store."""
+    if not _exists(store, PROFILES_GROUP):
+        return set()
+    with _open(store, PROFILES_GROUP) as profiles:
+        return set(profiles['PROFILE_ID'].values.astype(str))
+
+
+def _variable_flags(dataset: xr.Dataset) -> int:
+    return sum(1 << i for i, name in enumerate(_FLAGGED) if name in dataset.data_vars)
+
+
+def _conform(ragged: xr.Dataset, bookkeeping: xr.Dataset, source_dtypes: dict) -> tuple[xr.Dataset, xr.Dataset]:
+    """Splits ragged profiles into the datasets of the profiles and levels
+    groups, with the same variables whatever the profiles hold."""
+    n_prof = ragged.sizes.get('N_PROF', 0)
+    n_obs = ragged.sizes.get('obs', 0)
+    profiles = bookkeeping.assign(rowSize=(('N_PROF',), ragged['rowSize'].values.astype('int32')))
+    for name in argo.PROFILE_VARIABLES:
+        profiles[name] = ragged[name]
+    # Argo platform numbers are 8 characters
+    profiles['PLATFORM_NUMBER'] = (('N_PROF',), (
+        ragged['PLATFORM_NUMBER'].values.astype('S8')
+        if 'PLATFORM_NUMBER' in ragged else np.full(n_prof, b'', dtype='S8')
+    ), ragged['PLATFORM_NUMBER'].attrs if 'PLATFORM_NUMBER' in ragged else {})
+    # floats hold the cycles of all the files, and are cast back when read
+    profiles['CYCLE_NUMBER'] = (('N_PROF',), (
+        ragged['CYCLE_NUMBER'].values.astype('float64')
+        if 'CYCLE_NUMBER' in ragged else np.full(n_prof, np.nan)
+    ), {
+        **(ragged['CYCLE_NUMBER'].attrs if 'CYCLE_NUMBER' in ragged else {}),
+        'source_dtype': source_dtypes.get('CYCLE_NUMBER', 'float64'),
+    })
+    levels = xr.Dataset({argo.LEVEL_INDEX: ragged[argo.LEVEL_INDEX]})
+    for name in _LEVEL_SCHEMA:
+        if name in ragged:
+            levels[name] = ragged[name]
+        elif name.endswith('_QC'):
+            levels[name] = (('obs',), np.full(n_obs, b' ', dtype='S1'))
+        else:
+            levels[name] = (('obs',), np.full(n_obs, np.nan, dtype='float32'))
+    return profiles, levels
+
+
+def _chunks(dataset: xr.Dataset, size: int) -> dict:
+    return { name: {'chunks': (size,)} for name in dataset.data_vars }
+
+
+def append_profiles(store: Path, datasets: Sequence[xr.Dataset], ids: Sequence[str], replace: Sequence[str] = ()):
+    """Appends profiles read by `argo.open_profile` to a store, identifying
+    the profiles of each dataset with the matching entry of `ids`. Profiles
+    already in the store are skipped, unless their identifier is in `replace`:
+    the new version is then appended, and read in place of the old one."""
+    with store_lock(store):
+        stored = stored_profile_ids(store).difference(replace)
+        new = [i for i, id in enumerate(ids) if id not in stored]
+        if not new:
+            return
+        datasets = [datasets[i] for i in new]
+        ids = [ids[i] for i in new]
+        n_prof = [ds.sizes.get('N_PROF', 1) for ds in datasets]
+        # variable-length strings, so that batches of identifiers of
+        # different lengths can be appended
+        bookkeeping = xr.Dataset({
+            'PROFILE_ID': (('N_PROF',), np.repeat(np.array(ids, dtype=object), n_prof)),
+            'profileIndex': (('N_PROF',), np.concatenate([np.arange(n) for n in n_prof]).astype('int32')),
+            'nLevels': (('N_PROF',), np.repeat([ds.sizes.get('N_LEVELS', 0) for ds in datasets], n_prof).astype('int32')),
+            'variableFlags': (('N_PROF',), np.repeat([_variable_flags(ds) for ds in datasets], n_prof).astype('int32'), {
+                'flag_masks': [1 << i for i in range(len(_FLAGGED))],
+                'flag_meanings': ' '.join(_FLAGGED),
+            }),
+        })
+        source_dtypes = {
+            name: str(ds[name].dtype)
+            for ds in reversed(datasets) for name in argo.INDEX_VARIABLES if name in ds.data_vars
+        }
+        packed = argo.pack_profiles(datasets)
+        order = np.argsort(packed['JULD'].values, kind='stable')
+        packed = packed.isel(N_PROF=order)
+        profiles, levels = _conform(argo.to_ragged(packed, level_index=True), bookkeeping.isel(N_PROF=order), source_dtypes)
+
+        append = _exists(store, PROFILES_GROUP)
+        n_obs = 0
+        if append:
+            with _open(store, LEVELS_GROUP) as stored:
+                n_obs = stored.sizes['obs']
+        row_size = profiles['rowSize'].values.astype('int64')
+        profiles['rowStart'] = (('N_PROF',), n_obs + np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype('int64'))
+        # levels first, so that profiles never point past the stored levels
+        if append:
+            levels.to_zarr(store, group=LEVELS_GROUP, mode='a', append_dim='obs', consolidated=True)
+            profiles.to_zarr(store, group=PROFILES_GROUP, mode='a', append_dim='N_PROF', consolidated=True)
+        else:
+            levels.to_zarr(store, group=LEVELS_GROUP, mode='w', consolidated=True, encoding=_chunks(levels, LEVEL_CHUNK))
+            profiles.to_zarr(store, group=PROFILES_GROUP, mode='w', consolidated=True, encoding=_chunks(profiles, PROFILE_CHUNK))
+
+
+def read_profiles(
+    store: Path,
+    ids: Sequence[str],
+    variables: Sequence[str],
+    qc_flags: Sequence[str] | None = None,
+    select: Callable[[xr.Dataset], np.ndarray] | None = None,
+) -> xr.Dataset:
+    """Reads profiles from a store as a CF contiguous ragged array, with the
+    level variables in `variables` and the bookkeeping variables of the store.
+    Only the profiles whose identifier is in `ids` and, if given, selected by
+    the `select` mask function (called with the profiles group) are read. If
+    `qc_flags` is given, values whose QC flag is not in `qc_flags` are masked,
+    unless their file has no QC flags."""
+    with _open(store, PROFILES_GROUP) as profiles:
+        profiles = profiles.load()
+    profile_ids = profiles['PROFILE_ID'].values.astype(str)
+    mask = np.isin(profile_ids, np.array(list(ids), dtype=str))
+    # only the last version of replaced profiles
+    _, last = np.unique(profile_ids[::-1], return_index=True)
+    latest = np.zeros(len(profile_ids), dtype=bool)
+    latest[len(profile_ids) - 1 - last] = True
+    mask &= latest
+    if select is not None:
+        mask &= select(profiles)
+    profiles = profiles.isel(N_PROF=np.flatnonzero(mask))
+
+    row_start = profiles['rowStart'].values.astype('int64')
+    row_size = profiles['rowSize'].values.astype('int64')
+    offsets = np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype('int64')
+    obs = np.repeat(row_start - offsets, row_size) + np.arange(int(row_size.sum()))
+
+    qc_names = [f'{name}_QC' for name in variables] if qc_flags is not None else []
+    with _open(store, LEVELS_GROUP) as levels:
+        levels = levels[[argo.LEVEL_INDEX] + list(variables) + qc_names].isel(obs=obs).load()
+    if qc_names:
+        flags = np.repeat(profiles['variableFlags'].values, row_size)
+        unchecked = { name: (flags & (1 << _FLAGGED.index(name))) == 0 for name in qc_names }
+        levels = argo.mask_qc(levels, qc_names, qc_flags or [], unchecked).drop_vars(qc_names)
+
+    ragged = profiles.drop_vars(['rowStart']).merge(levels)
+    ragged.attrs['featureType'] = 'profile'
+    return ragged
+
+
+def read_datasets(
+    store: Path,
+    ids: Sequence[str],
+    variables: Sequence[str],
+    qc_flags: Sequence[str] | None = None,
+    select: Callable[[xr.Dataset], np.ndarray] | None = None,
+) -> List[xr.Dataset]:
+    """Reads profiles from a store as `read_profiles`, and returns them as
+    `argo.open_profile` returns the files they were compacted from: one
+    dataset per identifier of `ids`, in order, with the variables, levels and
+    dtypes of the file. Files lacking one of `variables`, or without any
+    selected profile, are left out."""
+    ragged = read_profiles(store, ids, variables, qc_flags, select)
+    rows: dict = {}
+    for row, id in enumerate(ragged['PROFILE_ID'].values.astype(str)):
+        rows.setdefault(id, []).append(row)
+    row_size = ragged['rowSize'].values.astype('int64')
+    row_start = np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype('int64')
+    profile_index = ragged['profileIndex'].values
+    datasets = []
+    for id in dict.fromkeys(ids):
+        if id not in rows:
+            continue
+        file_rows = np.array(rows[id])
+        file_rows = file_rows[np.argsort(profile_index[file_rows], kind='stable')]
+        flags = int(ragged['variableFlags'].values[file_rows[0]])
+        absent = [name for i, name in enumerate(_FLAGGED) if not flags & (1 << i)]
+        if any(name in absent for name in variables):
+            continue
+        obs = np.concatenate([np.arange(row_start[r], row_start[r] + row_size[r]) for r in file_rows]).astype('int64')
+        file = ragged.isel(N_PROF=file_rows, obs=obs).drop_vars(_BOOKKEEPING + [n for n in absent if n in ragged])
+        file = argo.from_ragged(file, int(ragged['nLevels'].values[file_rows[0]]))
+        for name, var in list(file.data_vars.items()):
+            attrs = dict(var.attrs)
+            dtype = attrs.pop('source_dtype', None)
+            if dtype is None:
+                continue
+            values = var.values
+            if np.dtype(dtype).kind in 'iu' and not np.isfinite(values).all():
+                dtype = values.dtype
+            file[name] = (var.dims, values.astype(dtype), attrs)
+        datasets.append(file)
+    return datasets
+
+
+_PROFILE_FILE = re.compile(r'(platform-.+_cycle-[^.]+)\.nc$')
+
+
+def compact_profile_files(store: Path, directory: Path, replace: Sequence[str] = ()) -> List[str]:
+    """Appends the profile files cached in `directory` (named after their
+    `platform-<platform>_cycle-<cycle>` identifier) to a store, then deletes
+    them. Profiles in `replace` are appended even if already stored. Returns
+    the identifiers of the appended profiles."""
+    # held throughout, so that concurrent queries do not compact, and
+    # delete, the same files
+    with store_lock(store):
+        stored = stored_profile_ids(store).difference(replace)
+        datasets, ids, files = [], [], []
+        for file in Path(directory).iterdir():
+            match = _PROFILE_FILE.search(file.name)
+            if match is None:
+                continue
+            files.append(file)
+            if match.group(1) in stored or match.group(1) in ids:
+                continue
+            dataset = argo.open_profile(file, [], optional_variables=argo.LEVEL_VARIABLES, keep_qc=True)
+            if dataset is not None:
+                datasets.append(dataset)
+                ids.append(match.group(1))
+        append_profiles(store, datasets, ids, replace)
+        for file in files:
+            file.unlink(missing_ok=True)
+        return ids
+
+
+def table_group(file_name: str) -> str:
+    """Group holding the compacted table cached as `file_name`."""
+    return hashlib.sha1(file_name.encode()).hexdigest()
+
+
+def has_table(store: Path, file_name: str) -> bool:
+    return _exists(store, table_group(file_name))
+
+
+_TABLE_ATTRIBUTES = ['source_file_name', 'variable_order']
+"""Attributes of the compacted tables used by the store only."""
+
+
+def compact_table(store: Path, file_name: str, source: Path, time: str):
+    """Re-encodes a cached NetCDF table into its group of a store, in its row
+    order and chunked along the dimension of `time`, then deletes the file."""
+    with argo.netcdf_lock(None), xr.open_dataset(source) as table:
+        dim = table[time].dims[0]
+        table = table.load()
+    encoding = _chunks(table[[name for name, var in table.data_vars.items() if var.dims == (dim,)]], LEVEL_CHUNK)
+    with store_lock(store):
+        group = table_group(file_name)
+        if Path(store).joinpath(group).exists():
+            shutil.rmtree(Path(store).joinpath(group))
+        table.attrs['source_file_name'] = file_name
+        # Zarr lists arrays by name
+        table.attrs['variable_order'] = list(table.variables)
+        table.to_zarr(store, group=group, mode='w', consolidated=True, encoding=encoding)
+    Path(source).unlink(missing_ok=True)
+
+
+def read_table(store: Path, file_name: str) -> xr.Dataset:
+    """Opens, lazily, the compacted table cached as `file_name`, as the
+    original file would be."""
+    table = _open(store, table_group(file_name))
+    order = table.attrs.get('variable_order', [])
+    table = table[[name for name in order if name in table.variables] + [name for name in table.data_vars if name not in order]]
+    table.attrs = {k: v for k, v in table.attrs.items() if k not in _TABLE_ATTRIBUTES}
+    return table
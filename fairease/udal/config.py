@@ -0,0 +1,11 @@
+from typing import Any
+
+from udal.specification import Config
+
+
+def option(config: Config | None, name: str, default: Any = None) -> Any:
+    """Implementation-specific setting, given as an attribute of the UDAL
+    configuration object (e.g. `config.memory_limit = 2 * 1024**3`)."""
+    if config is None:
+        return default
+    return getattr(config, name, default)
@@ -0,0 +1,86 @@
+"""Executors running the per-file work of the brokers in parallel.
+
+The executor is chosen with the `executor` setting of the configuration
+object:
+
+- `None` (default): files are processed one after the other, in the calling
+  thread;
+- `'threads'`: a thread pool;
+- `'processes'`: a local process pool;
+- `'dask'`: a dask distributed client, the one given as `dask_client` in the
+  configuration or else a new `LocalCluster`;
+- any `concurrent.futures.Executor` or dask `Client` instance.
+
+`max_workers` sets the size of the pools created here.
+"""
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List
+
+from udal.specification import Config
+
+from .config import option
+
+
+def create_executor(config: Config | None) -> Any:
+    """Executor selected by the configuration, or `None` to run serially."""
+    executor = option(config, 'executor')
+    max_workers = option(config, 'max_workers')
+    if executor is None or executor == 'serial':
+        return None
+    if executor == 'threads':
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='udal-files')
+    if executor == 'processes':
+        return ProcessPoolExecutor(max_workers=max_workers)
+    if executor == 'dask':
+        client = option(config, 'dask_client')
+        if client is None:
+            from dask.distributed import Client, LocalCluster
+            client = Client(LocalCluster(n_workers=max_workers, processes=True))
+        return client
+    if isinstance(executor, Executor) or hasattr(executor, 'gather'):
+        return executor
+    raise ValueError(f"Executor '{executor}' not supported. Please select one of the following executors: threads, processes, dask")
+
+
+def close_executor(executor: Any, config: Config | None):
+    """Shuts down an executor returned by `create_executor`, unless it was
+    given as an instance in the configuration. Work already submitted
+    completes."""
+    if executor is None or not isinstance(option(config, 'executor'), str):
+        return
+    if hasattr(executor, 'gather'):
+        if option(config, 'dask_client') is None:
+            cluster = executor.cluster
+            executor.close()
+            cluster.close()
+    else:
+        executor.shutdown(wait=False)
+
+
+def submit(executor: Any, fn: Callable, item: Any) -> Any:
+    """Starts `fn(item)` with `executor`, or runs it now if `executor` is
+    `None`, returning a future of its result."""
+    if executor is None:
+        future: Future = Future()
+        try:
+            future.set_result(fn(item))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    if hasattr(executor, 'gather'):
+        # dask distributed client
+        return executor.submit(fn, item, pure=False)
+    return executor.submit(fn, item)
+
+
+def map_ordered(executor: Any, fn: Callable, items: Iterable) -> List:
+    """Applies `fn` to every item with `executor`, returning the results in
+    the order of the items."""
+    items = list(items)
+    if executor is None or len(items) <= 1:
+        return [fn(item) for item in items]
+    if hasattr(executor, 'gather'):
+        # dask distributed client
+        return executor.gather(executor.map(fn, items, pure=False))
+    return list(executor.map(fn, items))
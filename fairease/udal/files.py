@@ -0,0 +1,49 @@
+"""Cache file writes safe for concurrent queries.
+
+Files are written to a temporary file in the same directory, then moved
+into place with `os.replace`, so readers only ever see complete files.
+`path_lock` serializes, within the process, the queries producing the same
+file, so that it is only downloaded once.
+"""
+
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import BinaryIO, Iterator
+import weakref
+
+
+# locks are dropped once no query holds them
+_locks: 'weakref.WeakValueDictionary[Path, threading.RLock]' = weakref.WeakValueDictionary()
+
+_locks_lock = threading.Lock()
+
+
+def path_lock(path: Path | str) -> threading.RLock:
+    """Lock of a cache file or directory within the process, shared by the
+    callers holding a reference to it."""
+    with _locks_lock:
+        path = Path(path).resolve()
+        lock = _locks.get(path)
+        if lock is None:
+            lock = threading.RLock()
+            _locks[path] = lock
+        return lock
+
+
+@contextmanager
+def atomic_write(path: Path | str) -> Iterator[BinaryIO]:
+    """Opens a temporary file for writing, moved to `path` once the block
+    completes, or deleted if it raises."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            yield file
+        os.replace(temp, path)
+    except BaseException:
+        Path(temp).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,167 @@
+import contextlib
+import threading
+import time
+from typing import Callable, ContextManager, Dict, Iterator, List, Tuple
+
+
+# Latency histogram buckets in seconds, from cache-hit reads to large
+# downloads.
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+    120.0, 300.0,
+)
+
+
+Tracer = Callable[[str, dict], ContextManager]
+"""Tracing hook: called with a span name and its attributes, returns a context
+manager wrapping the span (e.g. an OpenTelemetry
+``tracer.start_as_current_span``)."""
+
+
+_tracer: Tracer | None = None
+
+
+def set_tracer(tracer: Tracer | None):
+    """Sets (or clears, with `None`) the process-wide tracing hook used for
+    every query stage."""
+    global _tracer
+    _tracer = tracer
+
+
+class QueryMetrics:
+    """Timings and counters collected while a broker executes one query."""
+
+    COUNTERS = ('bytes', 'cache_hits', 'cache_misses', 'files')
+
+    def __init__(self, broker: str, query: str):
+        self.broker = broker
+        self.query = query
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, int] = { k: 0 for k in QueryMetrics.COUNTERS }
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._end: float | None = None
+
+    def finish(self):
+        """Marks the end of the query, fixing its total duration."""
+        if self._end is None:
+            self._end = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Times the enclosed block as stage `name`. Time spent in a stage
+        that is entered more than once is accumulated."""
+        tracer = _tracer
+        span = tracer(f'udal.{self.broker}.{name}', {
+            'udal.broker': self.broker,
+            'udal.query': self.query,
+            'udal.stage': name,
+        }) if tracer is not None else contextlib.nullcontext()
+        start = time.perf_counter()
+        try:
+            with span:
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def count(self, name: str, value: int = 1):
+        """Adds `value` to counter `name`."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        """Metrics as stored in `Result.metadata['metrics']`."""
+        end = self._end if self._end is not None else time.perf_counter()
+        with self._lock:
+            return {
+                'broker': self.broker,
+                'query': self.query,
+                'stages': dict(self.stages),
+                'total': end - self._start,
+                **self.counters,
+            }
+
+
+class _Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """Process-wide aggregation of query metrics: latency histograms per
+    broker and stage, and counter totals per broker."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str], _Histogram] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+
+    def record(self, metrics: QueryMetrics):
+        """Adds the metrics of one executed query."""
+        m = metrics.as_dict()
+        with self._lock:
+            for stage, seconds in list(m['stages'].items()) + [('total', m['total'])]:
+                key = (metrics.broker, stage)
+                if key not in self._histograms:
+                    self._histograms[key] = _Histogram(self._buckets)
+                self._histograms[key].observe(seconds)
+            for name in QueryMetrics.COUNTERS:
+                key = (metrics.broker, name)
+                self._counters[key] = self._counters.get(key, 0) + m[name]
+
+    def latency(self, broker: str, stage: str = 'total') -> Tuple[int, float]:
+        """Number of observations and their mean, in seconds, for a broker
+        stage (`(0, 0.0)` if never observed)."""
+        with self._lock:
+            h = self._histograms.get((broker, stage))
+            if h is None or h.count == 0:
+                return 0, 0.0
+            return h.count, h.sum / h.count
+
+    def counter(self, broker: str, name: str) -> int:
+        """Total of counter `name` over all queries of a broker."""
+        with self._lock:
+            return self._counters.get((broker, name), 0)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def export_prometheus(self) -> str:
+        """Registry contents in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            lines.append('# HELP udal_stage_duration_seconds Duration of UDAL query stages.')
+            lines.append('# TYPE udal_stage_duration_seconds histogram')
+            for (broker, stage), h in sorted(self._histograms.items()):
+                labels = f'broker="{broker}",stage="{stage}"'
+                for bound, n in zip(h.buckets, h.counts):
+                    lines.append(f'udal_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'udal_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f'udal_stage_duration_seconds_sum{{{labels}}} {h.sum}')
+                lines.append(f'udal_stage_duration_seconds_count{{{labels}}} {h.count}')
+            for name in QueryMetrics.COUNTERS:
+                lines.append(f'# TYPE udal_{name}_total counter')
+                for (broker, counter), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(f'udal_{name}_total{{broker="{broker}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+"""Registry shared by every broker in the process."""
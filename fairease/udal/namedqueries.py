@@ -43,6 +43,27 @@ QUERY_REGISTRY : dict[QueryName, NamedQueryInfo] = {
                 'bounding_box': udal.tdict('number'),
                 'longitude': 'number',
                 'latitude': 'number',
+                'qc_flags': ['str', udal.tlist('str')],
+                'layout': [udal.tliteral('datasets'), udal.tliteral('profiles'), udal.tliteral('ragged')],
+                'exact': 'bool',
+                'radius': 'number',
+                'watermark': udal.tdict(['str', udal.tlist('str')]),
             },
         ),
 }
+
+
+QUERY_TTL : dict[QueryName, float] = {
+    'urn:fairease.eu:udal:example:weekdays': 24 * 3600,
+    'urn:fairease.eu:udal:example:months': 24 * 3600,
+    'urn:fairease.eu:udal:example:translation': 24 * 3600,
+    'urn:fairease.eu:argo:data': 3600,
+}
+"""Seconds for which the results of each query may be reused by the result
+cache (`cache`). Queries without a TTL are not cached, and neither are those
+with a parameter of `UNCACHED_PARAMETERS`."""
+
+
+UNCACHED_PARAMETERS = ('watermark',)
+"""Parameters of queries whose result depends on more than the parameters:
+incremental queries return what is new since their watermark."""
@@ -0,0 +1,213 @@
+"""Pre-warms the cache of a broker with the Argo data of a region and period.
+
+The region and period are split into the queries the broker serves, which are
+then executed in parallel to fill the cache directory:
+
+- the period into windows of at most `--window` days (31 for Beacon);
+- the region into cells of `--step` degrees, queried by bounding box from
+  IDDAS (10 degrees by default) and by their centre point from Beacon (1
+  degree by default, as Beacon ignores bounding boxes and searches 0.5
+  degrees around a point).
+
+Queries are only cache hits later if issued with the same parameters, so jobs
+should query the same cells and windows.
+
+Every finished query is appended to a JSON lines journal (by default
+`prefetch.jsonl` in the cache directory). A run interrupted and started again
+with the same journal skips the queries already done, and the brokers do not
+download again the files already cached:
+
+    python -m fairease.udal.prefetch --cache-dir cache --token blue_cloud=... \\
+        --start 2024-01-01 --end 2024-03-31 --bbox 60 10 40 -20 \\
+        --parameters temperature salinity --workers 4
+"""
+
+import argparse
+import datetime
+import json
+from pathlib import Path
+import sys
+import time
+from typing import Dict, Iterator, List, Set
+
+import udal.specification as udal
+
+from .batch import Request, request_key
+from .udal import UDAL
+
+
+ARGO_QUERY = 'urn:fairease.eu:argo:data'
+
+BEACON = 'https://beacon-argo.maris.nl'
+
+IDDAS = 'https://fair-ease-iddas.maris.nl'
+
+BEACON_MAX_DAYS = 31
+
+
+def windows(start: datetime.date, end: datetime.date, days: int) -> Iterator[tuple[datetime.date, datetime.date]]:
+    """Consecutive periods of at most `days` days covering `start` to `end`
+    (inclusive)."""
+    while start <= end:
+        last = min(start + datetime.timedelta(days=days - 1), end)
+        yield start, last
+        start = last + datetime.timedelta(days=1)
+
+
+def _steps(first: float, last: float, step: float) -> List[float]:
+    values = []
+    while first + len(values) * step < last:
+        values.append(round(first + len(values) * step, 6))
+    return values
+
+
+def _longitude(value: float) -> float:
+    while value > 180:
+        value -= 360
+    return round(value, 6)
+
+
+def cells(north: float, east: float, south: float, west: float, step: float) -> Iterator[Dict[str, float]]:
+    """Bounding boxes of `step` degrees covering a region."""
+    if east < west:
+        # crosses the antimeridian
+        east += 360
+    for s in _steps(south, north, step):
+        for w in _steps(west, east, step):
+            e = w + step
+            yield {
+                'north': round(min(s + step, north), 6),
+                'east': _longitude(min(e, east)),
+                'south': s,
+                'west': _longitude(w),
+            }
+
+
+def plan(connection: str, args: argparse.Namespace) -> List[Request]:
+    """Queries covering the region, period and parameters of the arguments,
+    sized for the broker of `connection`."""
+    window = min(args.window, BEACON_MAX_DAYS) if connection == BEACON else args.window
+    step = args.step or (1 if connection == BEACON else 10)
+    requests: List[Request] = []
+    for start, end in windows(args.start, args.end, window):
+        for cell in cells(*args.bbox, step):
+            params: dict = {
+                'parameter': list(args.parameters),
+                'startTime': start.isoformat(),
+                'endTime': end.isoformat(),
+            }
+            if connection == BEACON:
+                params['latitude'] = round((cell['north'] + cell['south']) / 2, 6)
+                width = (cell['east'] - cell['west']) % 360
+                params['longitude'] = _longitude(cell['west'] + width / 2)
+            else:
+                params['bounding_box'] = cell
+            requests.append((ARGO_QUERY, params))
+    return requests
+
+
+def done_keys(journal: Path) -> Set[str]:
+    """Keys of the queries journaled as done (with or without data)."""
+    keys: Set[str] = set()
+    if not journal.exists():
+        return keys
+    with open(journal) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+            if entry.get('status') in ('done', 'empty'):
+                keys.add(entry['key'])
+    return keys
+
+
+def _status(error: Exception | None) -> str:
+    if error is None:
+        return 'done'
+    # the brokers fail on queries without data, which need no retry
+    if 'no data' in str(error).lower():
+        return 'empty'
+    return 'error'
+
+
+def prefetch(args: argparse.Namespace) -> int:
+    """Runs the queries not done yet, journaling each one. Returns the number
+    of failed queries."""
+    config = udal.Config()
+    config.cache_dir = str(args.cache_dir)
+    for token in args.token:
+        name, _, value = token.partition('=')
+        config.api_tokens[name] = value
+    if args.compact:
+        config.compact_cache = True # type: ignore
+
+    journal = Path(args.journal or Path(args.cache_dir).joinpath('prefetch.jsonl'))
+    requests = plan(args.connection, args)
+    done = done_keys(journal)
+    pending = [r for r in requests if request_key(*r) not in done]
+    print(f'{len(requests)} queries, {len(requests) - len(pending)} already done', file=sys.stderr)
+    if args.dry_run:
+        for name, params in pending:
+            print(json.dumps({'name': name, 'params': params}))
+        return 0
+
+    Path(args.cache_dir).mkdir(parents=True, exist_ok=True)
+    failed = 0
+    started = time.perf_counter()
+    with open(journal, 'a') as f:
+        items = UDAL(args.connection, config).execute_many(pending, args.workers, ordered=False)
+        for n, item in enumerate(items, 1):
+            status = _status(item.error)
+            failed += status == 'error'
+            metrics = item.result.metadata.get('metrics', {}) if item.result is not None else {}
+            f.write(json.dumps({
+                'key': request_key(item.name, item.params),
+                'name': item.name,
+                'params': item.params,
+                'status': status,
+                'error': None if item.error is None else str(item.error),
+                'seconds': metrics.get('total'),
+                'cache_hits': metrics.get('cache_hits'),
+                'cache_misses': metrics.get('cache_misses'),
+                'finished': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }) + '\n')
+            f.flush()
+            print(f'[{n}/{len(pending)}] {status} after {time.perf_counter() - started:.1f}s', file=sys.stderr)
+    return failed
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m fairease.udal.prefetch',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--connection', default=IDDAS, choices=[IDDAS, BEACON], help='broker to pre-warm')
+    parser.add_argument('--cache-dir', required=True, type=Path)
+    parser.add_argument('--token', action='append', default=[], metavar='NAME=TOKEN',
+                        help='API token, e.g. blue_cloud=... or beacon=...')
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat)
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat)
+    parser.add_argument('--bbox', nargs=4, type=float, default=[90, 180, -90, -180],
+                        metavar=('NORTH', 'EAST', 'SOUTH', 'WEST'))
+    parser.add_argument('--step', type=float, default=None,
+                        help='cell size in degrees (default: 1 for Beacon, 10 for IDDAS)')
+    parser.add_argument('--window', type=int, default=BEACON_MAX_DAYS, help='query period in days')
+    parser.add_argument('--parameters', nargs='+', default=['temperature', 'salinity', 'pressure'])
+    parser.add_argument('--workers', type=int, default=None, help='queries run in parallel')
+    parser.add_argument('--journal', default=None, help='progress journal (JSON lines)')
+    parser.add_argument('--compact', action='store_true', help='compact the cache into Zarr stores')
+    parser.add_argument('--dry-run', action='store_true', help='print the pending queries and exit')
+    args = parser.parse_args(argv)
+    if args.end < args.start:
+        parser.error('--end must not be before --start')
+    if (args.step is not None and args.step <= 0) or args.window <= 0:
+        parser.error('--step and --window must be positive')
+
+    sys.exit(1 if prefetch(args) else 0)
+
+
+if __name__ == '__main__':
+    main()
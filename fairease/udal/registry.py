@@ -0,0 +1,190 @@
+from collections import OrderedDict
+import copy
+from importlib import import_module
+from importlib.metadata import entry_points
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from udal.specification import Config
+
+from .broker import Broker
+
+
+BrokerFactory = Callable[[Config], Broker]
+"""Callable building a broker from the UDAL configuration, usually the broker
+class itself."""
+
+
+BrokerReference = BrokerFactory | str
+"""Broker factory, or its import path as `'module:attribute'` so that the
+module (and its dependencies) is only imported when the broker is first
+needed."""
+
+
+SchemeFactory = Callable[[str, Config], Broker]
+"""Callable building a broker from its connection string and the UDAL
+configuration."""
+
+
+ENTRY_POINT_GROUP = 'fairease.udal.brokers'
+"""Entry point group through which installed packages add brokers. The entry
+point name is the connection string and its value the broker factory, e.g. in
+`pyproject.toml`:
+
+    [tool.poetry.plugins."fairease.udal.brokers"]
+    "https://example.org/" = "mypackage.broker:ExampleBroker"
+"""
+
+
+_factories: Dict[str | None, BrokerReference] = {}
+
+_schemes: Dict[str, SchemeFactory | str] = {}
+
+POOL_SIZE = 32
+"""Broker instances kept in the pool, least recently used first out."""
+
+_pool: 'OrderedDict[Tuple[str | None, Any], Broker]' = OrderedDict()
+
+_lock = threading.RLock()
+
+_entry_points_loaded = False
+
+
+def register_broker(connectionString: str | None, factory: BrokerReference):
+    """Registers the broker serving `connectionString` (`None` for the default
+    broker). Registering a connection string again replaces its factory and
+    drops the pooled instances built by the previous one."""
+    with _lock:
+        _factories[connectionString] = factory
+        for key in [k for k in _pool if k[0] == connectionString]:
+            _pool.pop(key).close()
+
+
+def register_scheme(prefix: str, factory: SchemeFactory | str):
+    """Registers the broker serving every connection string starting with
+    `prefix` (e.g. `'udal+http://'`) that is not registered by itself. The
+    factory, or its import path, is given the connection string along with
+    the configuration."""
+    with _lock:
+        _schemes[prefix] = factory
+        for key in [k for k in _pool if k[0] is not None and k[0].startswith(prefix)]:
+            _pool.pop(key).close()
+
+
+def connection_strings() -> List[str | None]:
+    """Connection strings of all the registered brokers."""
+    with _lock:
+        _load_entry_points()
+        return list(_factories.keys())
+
+
+def get_broker(connectionString: str | None, config: Config) -> Broker:
+    """Broker for `connectionString` and `config`, reusing the instance
+    created by a previous call with the same connection string and an equal
+    configuration. New instances are given a copy of `config`, so that later
+    changes to it do not affect them."""
+    key = (connectionString, config_key(config))
+    with _lock:
+        broker = _pool.get(key)
+        if broker is None:
+            _load_entry_points()
+            if connectionString in _factories:
+                broker = _resolve(connectionString)(_copy_config(config))
+            else:
+                prefix = _scheme(connectionString)
+                if prefix is None:
+                    raise Exception(f'unsupported connection string "{connectionString}"')
+                broker = _resolve_scheme(prefix)(connectionString, _copy_config(config))
+            _pool[key] = broker
+            while len(_pool) > POOL_SIZE:
+                _pool.popitem(last=False)[1].close()
+        else:
+            _pool.move_to_end(key)
+        return broker
+
+
+def evict(connectionString: str | None):
+    """Drops the pooled instances serving `connectionString`, closing them."""
+    with _lock:
+        for key in [k for k in _pool if k[0] == connectionString]:
+            _pool.pop(key).close()
+
+
+def clear_pool():
+    """Drops all the pooled broker instances, closing them."""
+    with _lock:
+        while _pool:
+            _pool.popitem()[1].close()
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    for ep in entry_points(group=ENTRY_POINT_GROUP):
+        if ep.name not in _factories:
+            _factories[ep.name] = ep.value
+
+
+def _import(path: str) -> Any:
+    module, _, attribute = path.partition(':')
+    return getattr(import_module(module), attribute)
+
+
+def _resolve(connectionString: str | None) -> BrokerFactory:
+    factory = _factories[connectionString]
+    if isinstance(factory, str):
+        factory = _import(factory)
+        _factories[connectionString] = factory
+    return factory
+
+
+def _scheme(connectionString: str | None) -> str | None:
+    """Longest registered scheme prefix of `connectionString`."""
+    if connectionString is None:
+        return None
+    prefixes = [p for p in _schemes if connectionString.startswith(p)]
+    return max(prefixes, key=len) if prefixes else None
+
+
+def _resolve_scheme(prefix: str) -> SchemeFactory:
+    factory = _schemes[prefix]
+    if isinstance(factory, str):
+        factory = _import(factory)
+        _schemes[prefix] = factory
+    return factory
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+def _copy_config(config: Config) -> Config:
+    """Copy of the configuration and of its dictionaries and lists (e.g.
+    `api_tokens`). Other values, such as executors, are shared."""
+    if config is None:
+        return config
+    config = copy.copy(config)
+    for name, value in list(vars(config).items()):
+        if isinstance(value, (dict, list, set)):
+            setattr(config, name, copy.copy(value))
+    return config
+
+
+def config_key(config: Config) -> Any:
+    """Hashable snapshot of the configuration contents."""
+    if config is None:
+        return None
+    try:
+        return _freeze(vars(config))
+    except TypeError:
+        return repr(config)
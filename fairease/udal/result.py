@@ -1,20 +1,32 @@
-import pandas
-from typing import Any
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
 
 import udal.specification as udal
 
 from .namedqueries import NamedQueryInfo
 
+if TYPE_CHECKING:
+    import pandas
+
+
+class _DataFrameType:
+    """`pandas.DataFrame`, imported on first access."""
+
+    def __get__(self, obj, objtype=None):
+        import pandas
+        return pandas.DataFrame
+
 
 class Result(udal.Result):
     """Result from executing an UDAL query."""
 
-    Type = pandas.DataFrame
+    Type = _DataFrameType()
 
-    def __init__(self, query: NamedQueryInfo, data: Any, metadata: dict = {}):
+    def __init__(self, query: NamedQueryInfo, data: Any, metadata: dict | None = None):
         self._query = query
         self._data = data
-        self._metadata = metadata
+        self._metadata = metadata if metadata is not None else {}
 
     @property
     def query(self):
@@ -27,8 +39,8 @@ class Result(udal.Result):
         """Metadata associated with the result data."""
         return self._metadata
 
-    def data(self, type: type[Type] | None = None) -> Type:
+    def data(self, type: type[pandas.DataFrame] | None = None) -> pandas.DataFrame:
         """The data of the result."""
-        if type is None or type is pandas.DataFrame:
+        if type is None or type is Result.Type:
             return self._data
         raise Exception(f'type "{type}" not supported')
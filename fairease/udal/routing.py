@@ -0,0 +1,218 @@
+"""Routing of queries to the cheapest of several brokers.
+
+`RoutingBroker` (connection string `auto`) answers each query with one of its
+backends, chosen by estimated cost. A backend is left out when it cannot
+answer the query as asked: Beacon serves at most 31 days, ignores bounding
+boxes and does not support the `layout` and `qc_flags` parameters of IDDAS,
+and a watermark is only understood by the backend that issued it. Watermarks
+returned through the router name their backend in `broker`, so that a harvest
+keeps using it. The cost of the others is estimated in seconds from the query
+shape:
+
+- a fixed overhead per query, plus
+- a cost per unit of work: the expected profiles downloaded. IDDAS downloads
+  one archive per profile matched; Beacon returns one table per query, cheap
+  per profile, but holding all the profiles of the period unless the query
+  gives a point (bounding boxes are applied after download).
+
+The work missed by the cache is scaled by the cache hit ratio of the backend
+so far (from `metrics.REGISTRY`). The estimate is then corrected by the ratio
+of measured to estimated time of the queries that backend answered, so the
+routing follows the live latency and throughput of each backend.
+"""
+
+import datetime
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+from udal.specification import Config, NamedQueryInfo
+
+from .broker import Broker
+from .metrics import REGISTRY
+from .namedqueries import QueryName, QUERY_NAMES
+from .registry import get_broker
+from .result import Result
+
+
+BEACON = 'https://beacon-argo.maris.nl'
+
+IDDAS = 'https://fair-ease-iddas.maris.nl'
+
+BEACON_MAX_DAYS = 31
+
+PROFILES_PER_DAY_AND_SQUARE_DEGREE = 0.015
+"""Approximate density of Argo profiles over the oceans."""
+
+OCEAN_SQUARE_DEGREES = 0.7 * 360 * 180
+
+COST_MODELS: Dict[str, Tuple[float, float]] = {
+    BEACON: (2.0, 0.02),
+    IDDAS: (3.0, 0.5),
+}
+"""Prior `(overhead, cost per unit of work)`, in seconds, of each backend."""
+
+IDDAS_PARAMETERS = ('layout', 'qc_flags')
+"""Parameters only supported by IDDAS."""
+
+_SMOOTHING = 0.3
+
+
+def _days(params: dict) -> float | None:
+    if 'startTime' not in params or 'endTime' not in params:
+        return None
+    start = datetime.date.fromisoformat(params['startTime'])
+    end = datetime.date.fromisoformat(params['endTime'])
+    return (end - start).days + 1
+
+
+def _area(params: dict, radius: float) -> float:
+    """Square degrees searched by the query."""
+    if 'bounding_box' in params:
+        bbox = params['bounding_box']
+        width = (bbox['east'] - bbox['west']) % 360 or 360
+        return min(width * (bbox['north'] - bbox['south']), OCEAN_SQUARE_DEGREES)
+    if 'latitude' in params and 'longitude' in params:
+        return (2 * radius) ** 2
+    return OCEAN_SQUARE_DEGREES
+
+
+def _beacon_area(params: dict) -> float:
+    """Square degrees downloaded by Beacon, which filters on the latitude and
+    longitude of a point (within 0.5 degrees) but not on bounding boxes."""
+    height = 1 if 'latitude' in params else 180
+    width = 1 if 'longitude' in params else 360
+    return min(height * width, OCEAN_SQUARE_DEGREES)
+
+
+def issuer(watermark: dict | None) -> str | None:
+    """Backend which issued a watermark, or `None` for an empty one."""
+    watermark = watermark or {}
+    if watermark.get('broker'):
+        return watermark['broker']
+    if 'time' in watermark:
+        return BEACON
+    if 'modified' in watermark or 'seen' in watermark:
+        return IDDAS
+    return None
+
+
+def work(backend: str, params: dict) -> float | None:
+    """Units of work of an Argo query for `backend`, or `None` if the backend
+    cannot answer it."""
+    days = _days(params)
+    watermark_backend = issuer(params.get('watermark'))
+    if watermark_backend is not None and watermark_backend != backend:
+        return None
+    if backend == BEACON:
+        if any(name in params for name in IDDAS_PARAMETERS):
+            return None
+        if days is None or days - 1 > BEACON_MAX_DAYS:
+            return None
+        if 'bounding_box' in params and not params.get('exact'):
+            return None
+        return max(days * _beacon_area(params) * PROFILES_PER_DAY_AND_SQUARE_DEGREE, 1)
+    if backend == IDDAS:
+        # datasets are matched within 10 degrees of a point
+        area = _area(params, 10)
+        return max((days or 365) * area * PROFILES_PER_DAY_AND_SQUARE_DEGREE, 1)
+    return None
+
+
+class RoutingBroker(Broker):
+
+    _name = 'auto'
+
+    _config: Config
+
+    def __init__(self, config: Config, backends: Sequence[str] = (BEACON, IDDAS)):
+        self._config = config
+        self._backends = list(backends)
+        self._brokers: Dict[str, Broker | None] = {}
+        # per backend, smoothed ratio of measured to estimated time
+        self._calibration: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _broker(self, backend: str) -> Broker | None:
+        """Broker of `backend`, or `None` if it cannot be created (e.g. for
+        lack of a token)."""
+        with self._lock:
+            if backend not in self._brokers:
+                try:
+                    self._brokers[backend] = get_broker(backend, self._config)
+                except Exception:
+                    self._brokers[backend] = None
+            return self._brokers[backend]
+
+    @property
+    def queries(self) -> dict[str, NamedQueryInfo]:
+        queries: dict[str, NamedQueryInfo] = {}
+        for backend in self._backends:
+            broker = self._broker(backend)
+            if broker is not None:
+                queries.update(broker.queries)
+        return queries
+
+    def _prior(self, backend: str, params: dict) -> float | None:
+        units = work(backend, params)
+        if units is None:
+            return None
+        broker = self._brokers.get(backend)
+        overhead, per_unit = COST_MODELS[backend]
+        if broker is not None:
+            hits = REGISTRY.counter(broker._name, 'cache_hits')
+            misses = REGISTRY.counter(broker._name, 'cache_misses')
+            if hits + misses:
+                per_unit *= misses / (hits + misses)
+        return overhead + per_unit * units
+
+    def estimate(self, name: QueryName, params: dict | None = None) -> Dict[str, float | None]:
+        """Estimated cost, in seconds, of the query for each backend (`None`
+        for those unable to answer it)."""
+        params = params or {}
+        costs: Dict[str, float | None] = {}
+        for backend in self._backends:
+            broker = self._broker(backend)
+            if broker is None or name not in broker.queries:
+                costs[backend] = None
+                continue
+            prior = self._prior(backend, params)
+            costs[backend] = None if prior is None else prior * self._calibration.get(backend, 1.0)
+        return costs
+
+    def _observe(self, backend: str, prior: float, elapsed: float):
+        with self._lock:
+            ratio = elapsed / prior if prior > 0 else 1.0
+            previous = self._calibration.get(backend)
+            self._calibration[backend] = ratio if previous is None else \
+                (1 - _SMOOTHING) * previous + _SMOOTHING * ratio
+
+    def execute(self, name: QueryName, params: dict | None = None) -> Result:
+        params = params or {}
+        costs = self.estimate(name, params)
+        candidates: List[str] = sorted(
+            (backend for backend, cost in costs.items() if cost is not None),
+            key=lambda backend: costs[backend],  # type: ignore
+        )
+        if not candidates:
+            if name in QUERY_NAMES:
+                raise Exception(f'no broker can answer query "{name}" with these parameters')
+            raise Exception(f'unknown query name "{name}"')
+
+        # backends are tried from the cheapest, falling back to the next on error
+        error: Exception | None = None
+        for backend in candidates:
+            broker = self._brokers[backend]
+            prior = self._prior(backend, params)
+            try:
+                result = broker.execute(name, dict(params))  # type: ignore
+            except Exception as e:
+                error = e
+                continue
+            elapsed = result.metadata.get('metrics', {}).get('total')
+            if elapsed is not None and prior is not None:
+                self._observe(backend, prior, elapsed)
+            result.metadata['route'] = {'broker': backend, 'estimates': costs}
+            if 'watermark' in result.metadata:
+                result.metadata['watermark'] = {**result.metadata['watermark'], 'broker': backend}
+            return result
+        raise error  # type: ignore
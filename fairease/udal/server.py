@@ -0,0 +1,186 @@
+"""Long-running query server sharing warm brokers and caches between clients.
+
+The server holds one configuration (cache directory, API tokens and
+implementation-specific settings) and the pooled brokers built from it, and
+exposes them over HTTP, on a TCP port or a Unix socket:
+
+- `GET /queries?broker=<connection string>`: names of the queries supported
+  by a broker, as a JSON list;
+- `POST /execute`: executes the query given by the JSON body
+  `{"broker": ..., "name": ..., "params": {...}}` and sends back its result
+  as encoded by `transport`.
+
+Without `broker`, the server's default connection string is used. Clients may
+only select the brokers registered with `registry.register_broker`, not
+connection strings served by a scheme such as `udal+http://`, so that the
+server cannot be used as a proxy. Errors are returned as `{"error": ...}`
+with status 400 (bad request or invalid parameters) or 500 (failed query or
+encoding).
+
+Clients connect through the `udal+http://` and `udal+unix://` connection
+strings (see `brokers.remote`). Start the server with:
+
+    python -m fairease.udal.server --port 8765 --cache-dir cache --token beacon=...
+    python -m fairease.udal.server --unix /tmp/udal.sock --cache-dir cache
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import socketserver
+import sys
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+import udal.specification as udal
+
+from . import transport
+from .registry import connection_strings
+from .udal import UDAL
+
+
+DEFAULT_PORT = 8765
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_version = 'fairease-udal'
+
+    # set on the subclass built by `make_server`
+    config: udal.Config
+    default_broker: str | None
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def _send_json(self, status: int, body: Any):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _udal(self, broker: str | None) -> UDAL:
+        if broker is None:
+            broker = self.default_broker
+        elif broker not in connection_strings():
+            raise Exception(f'broker "{broker}" is not served')
+        # brokers are pooled per connection string and configuration
+        return UDAL(broker, self.config)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/health':
+            return self._send_json(200, {'status': 'ok'})
+        if url.path != '/queries':
+            return self._send_json(404, {'error': f'not found: {url.path}'})
+        try:
+            udal = self._udal(query.get('broker', [None])[0])
+        except Exception as e:
+            return self._send_json(400, {'error': str(e)})
+        return self._send_json(200, list(udal.queries.keys()))
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/execute':
+            return self._send_json(404, {'error': f'not found: {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            udal = self._udal(request.get('broker'))
+            name = request['name']
+        except Exception as e:
+            return self._send_json(400, {'error': str(e)})
+        try:
+            result = udal.execute(name, request.get('params'))
+            data = result.data()
+            format = transport.data_format(data)
+            # encoded before the status is sent, so that errors can be reported
+            head, body = transport.encode_response(result.metadata, data, format)
+        except ValueError as e:
+            # invalid parameters
+            return self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            return self._send_json(500, {'error': str(e)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', transport.CONTENT_TYPES[format])
+        self.send_header(transport.FORMAT_HEADER, format)
+        if isinstance(body, bytes):
+            self.send_header('Content-Length', str(len(head) + len(body)))
+        else:
+            # Arrow record batches are written as they are produced, without
+            # a length: the end of the body is the end of the connection
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        transport.write_response(head, body, format, self.wfile)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def make_server(
+    config: udal.Config,
+    host: str = '127.0.0.1',
+    port: int = DEFAULT_PORT,
+    unix_socket: str | None = None,
+    default_broker: str | None = None,
+) -> socketserver.BaseServer:
+    """Server answering the queries of clients with the brokers built from
+    `config`, on `host` and `port`, or on `unix_socket` if given. Run it with
+    `serve_forever()`."""
+    handler = type('Handler', (_Handler,), {'config': config, 'default_broker': default_broker})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        return _UnixServer(unix_socket, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m fairease.udal.server',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', default=None, metavar='PATH', help='listen on a Unix socket instead')
+    parser.add_argument('--broker', default=None, help='default connection string')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--token', action='append', default=[], metavar='NAME=TOKEN',
+                        help='API token, e.g. blue_cloud=... or beacon=...')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=JSON',
+                        help='implementation-specific setting, e.g. compact_cache=true')
+    args = parser.parse_args(argv)
+
+    config = udal.Config()
+    config.cache_dir = args.cache_dir
+    for token in args.token:
+        name, _, value = token.partition('=')
+        config.api_tokens[name] = value
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        setattr(config, name, json.loads(value))
+
+    server = make_server(config, args.host, args.port, args.unix, args.broker)
+    where = args.unix or f'http://{args.host}:{args.port}'
+    print(f'serving UDAL queries on {where}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Encoding of query results exchanged between the query server and
+`RemoteBroker`.
+
+A response body is one line of JSON with the result metadata, followed by the
+data in the format named by the `X-UDAL-Format` header:
+
+- `arrow`: a `pandas.DataFrame` as an Arrow IPC stream;
+- `netcdf`: an `xarray.Dataset` as a NetCDF 4 file;
+- `zip`: a list, as a ZIP archive of its items, in order, each named
+  `<index>.<format>`;
+- `json`: anything else serializable as JSON.
+
+Data frames are written in Arrow record batches as they are converted, other
+formats once fully encoded, so that their length is known.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+from typing import IO, Any, Tuple
+import zipfile
+
+
+FORMAT_HEADER = 'X-UDAL-Format'
+
+CONTENT_TYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'netcdf': 'application/x-netcdf',
+    'zip': 'application/zip',
+    'json': 'application/json',
+}
+
+CHUNK_SIZE = 1 << 16
+
+
+def data_format(data: Any) -> str:
+    """Format in which `data` is sent."""
+    if isinstance(data, list):
+        return 'zip'
+    if hasattr(data, 'data_vars'):
+        return 'netcdf'
+    if hasattr(data, 'columns') and hasattr(data, 'dtypes'):
+        return 'arrow'
+    return 'json'
+
+
+def encode(data: Any, format: str) -> Any:
+    """`data` ready to be written in `format`: its bytes, or, for `arrow`, an
+    Arrow table, written by `write` in record batches. Conversion errors are
+    raised here."""
+    if format == 'arrow':
+        import pyarrow as pa
+        return pa.Table.from_pandas(data, preserve_index=False)
+    return _encode_bytes(data, format)
+
+
+def _encode_bytes(data: Any, format: str) -> bytes:
+    buffer = io.BytesIO()
+    write(data, format, buffer)
+    return buffer.getvalue()
+
+
+def write(data: Any, format: str, file: IO[bytes]):
+    """Writes `data` in `format` to `file`."""
+    if format == 'arrow':
+        import pyarrow as pa
+        table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+        with pa.ipc.new_stream(file, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=CHUNK_SIZE):
+                writer.write_batch(batch)
+    elif format == 'netcdf':
+        # h5netcdf closes file objects it writes to, so the dataset goes
+        # through a temporary file
+        fd, path = tempfile.mkstemp(suffix='.nc')
+        os.close(fd)
+        try:
+            data.to_netcdf(path, engine='h5netcdf')
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, file, CHUNK_SIZE)
+        finally:
+            os.unlink(path)
+    elif format == 'zip':
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:
+            for i, item in enumerate(data):
+                item_format = data_format(item)
+                z.writestr(f'{i}.{item_format}', _encode_bytes(item, item_format))
+        file.write(buffer.getvalue())
+    elif format == 'json':
+        file.write(json.dumps(data, default=str).encode())
+    else:
+        raise ValueError(f'unsupported format "{format}"')
+
+
+def encode_response(metadata: dict, data: Any, format: str) -> Tuple[bytes, Any]:
+    """Head (the metadata line) and body (see `encode`) of a response."""
+    return json.dumps(metadata, default=str).encode() + b'\n', encode(data, format)
+
+
+def write_response(head: bytes, body: Any, format: str, file: IO[bytes]):
+    """Writes a response encoded by `encode_response` to `file`."""
+    file.write(head)
+    if isinstance(body, bytes):
+        file.write(body)
+    else:
+        write(body, format, file)
+
+
+def read(format: str, file: IO[bytes]) -> Any:
+    """Reads data written by `write` in `format` from `file`."""
+    if format == 'arrow':
+        import pyarrow as pa
+        return pa.ipc.open_stream(file).read_pandas()
+    payload = file.read()
+    if format == 'netcdf':
+        import xarray as xr
+        with xr.open_dataset(io.BytesIO(payload), engine='h5netcdf') as data:
+            return data.load()
+    if format == 'zip':
+        with zipfile.ZipFile(io.BytesIO(payload)) as z:
+            names = sorted(z.namelist(), key=lambda name: int(name.split('.')[0]))
+            return [read(name.split('.', 1)[1], io.BytesIO(z.read(name))) for name in names]
+    if format == 'json':
+        return json.loads(payload)
+    raise ValueError(f'unsupported format "{format}"')
+
+
+def read_response(format: str, file: IO[bytes]) -> Tuple[dict, Any]:
+    metadata = json.loads(file.readline())
+    return metadata, read(format, file)
@@ -1,36 +1,51 @@
-from typing import Literal
+from typing import Iterable, Iterator, List, Literal
 
 import udal.specification as udal
 
-from .brokers.local import LocalBroker
-from .brokers.wikidata import WikidataBroker
-from .brokers.beacon import BeaconBroker
-from .brokers.iddas import IDDASBroker
+from . import cache
+from .batch import BatchItem, Request, execute_many
 from .namedqueries import QUERY_NAMES, QueryName
+from .registry import get_broker, register_broker, register_scheme
 from .result import Result
 
-Connection = Literal['https://www.wikidata.org/', 'https://beacon-argo.maris.nl', 'https://fair-ease-iddas.maris.nl']
+Connection = Literal['https://www.wikidata.org/', 'https://beacon-argo.maris.nl', 'https://fair-ease-iddas.maris.nl', 'auto']
+
+
+# Brokers are registered by import path so that they, and their dependencies,
+# are only imported when a connection string first needs them.
+register_broker(None, 'fairease.udal.brokers.local:LocalBroker')
+register_broker('https://www.wikidata.org/', 'fairease.udal.brokers.wikidata:WikidataBroker')
+register_broker('https://beacon-argo.maris.nl', 'fairease.udal.brokers.beacon:BeaconBroker')
+register_broker('https://fair-ease-iddas.maris.nl', 'fairease.udal.brokers.iddas:IDDASBroker')
+register_broker('auto', 'fairease.udal.routing:RoutingBroker')
+register_scheme('udal+http://', 'fairease.udal.brokers.remote:RemoteBroker')
+register_scheme('udal+unix://', 'fairease.udal.brokers.remote:RemoteBroker')
+
 
 class UDAL(udal.UDAL):
     """Uniform Data Access Layer"""
 
-    def __init__(self, connectionString: Connection | None = None, config: udal.Config = udal.Config()):
+    def __init__(self, connectionString: Connection | str | None = None, config: udal.Config = udal.Config()):
         self._config = config
-        if connectionString is None:
-            self._broker = LocalBroker()
-        elif connectionString == 'https://www.wikidata.org/':
-            self._broker = WikidataBroker()
-        elif connectionString == 'https://beacon-argo.maris.nl':
-            self._broker = BeaconBroker(self._config)
-        elif connectionString == 'https://fair-ease-iddas.maris.nl':
-            self._broker = IDDASBroker(self._config)
+        self._connectionString = connectionString
+        self._broker = get_broker(connectionString, self._config)
+        self._cache = cache.result_cache(self._config)
 
     def execute(self, name: str, params: dict|None = None) -> Result:
         if name in QUERY_NAMES:
+            if self._cache is not None:
+                return cache.execute(self._cache, self._connectionString, self._config, self._broker.execute, name, params)
             return self._broker.execute(name, params)
         else:
             raise Exception(f'query {name} not supported')
 
+    def execute_many(self, requests: Iterable[Request], max_workers: int | None = None, ordered: bool = True) -> List[BatchItem] | Iterator[BatchItem]:
+        """Executes a batch of `(name, params)` requests in parallel.
+        Identical requests are executed only once. Errors are collected in the
+        returned items instead of aborting the batch. Items are returned in
+        input order, or yielded as they complete if `ordered` is false."""
+        return execute_many(self._broker, self.execute, requests, max_workers, ordered)
+
     @property
     def queries(self) -> dict[str, udal.NamedQueryInfo]:
         return self._broker.queries
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('zarr')
+
+from fairease.udal import compaction
+
+
+def profile(platform: str, cycle: int, levels: int = 3) -> xr.Dataset:
+    """One profile as read by `argo.open_profile`."""
+    return xr.Dataset({
+        'PLATFORM_NUMBER': (('N_PROF',), np.array([platform.ljust(8)], dtype='S8')),
+        'CYCLE_NUMBER': (('N_PROF',), np.array([cycle], dtype='int32')),
+        'JULD': (('N_PROF',), np.array([np.datetime64('2017-01-01T00:00:00', 'ns') + np.timedelta64(cycle, 'D')])),
+        'LATITUDE': (('N_PROF',), np.array([8.5])),
+        'LONGITUDE': (('N_PROF',), np.array([95.5])),
+        'PRES': (('N_PROF', 'N_LEVELS'), np.arange(levels, dtype='float32')[np.newaxis, :]),
+    })
+
+
+def test_append_ids_of_different_lengths(tmp_path):
+    store = tmp_path / 'argo.zarr'
+    compaction.append_profiles(store, [profile('1901', 1)], ['platform-1901_cycle-1'])
+    compaction.append_profiles(
+        store,
+        [profile('1901', 12), profile('6903001', 123)],
+        ['platform-1901_cycle-12', 'platform-6903001_cycle-123'],
+    )
+
+    ids = ['platform-1901_cycle-1', 'platform-1901_cycle-12', 'platform-6903001_cycle-123']
+    assert compaction.stored_profile_ids(store) == set(ids)
+    ragged = compaction.read_profiles(store, ids, ['PRES'])
+    assert ragged.sizes['N_PROF'] == 3
+    assert sorted(ragged['CYCLE_NUMBER'].values.tolist()) == [1, 12, 123]
+
+
+def test_read_datasets_as_the_files(tmp_path):
+    store = tmp_path / 'argo.zarr'
+    first = profile('1901', 2, levels=5)
+    # a level without data within the profile
+    first['PRES'][0, 1] = np.nan
+    second = profile('6903001', 1, levels=3).drop_vars('CYCLE_NUMBER')
+    compaction.append_profiles(store, [first, second], ['platform-1901_cycle-2', 'platform-6903001_cycle-1'])
+
+    datasets = compaction.read_datasets(store, ['platform-1901_cycle-2', 'platform-6903001_cycle-1'], ['PRES'])
+    assert len(datasets) == 2
+    for read, original in zip(datasets, [first, second]):
+        assert set(read.data_vars) == set(original.data_vars)
+        xr.testing.assert_equal(read, original)
+        for name in original.data_vars:
+            assert read[name].dtype == original[name].dtype
+
+
+def test_read_table_as_the_file(tmp_path):
+    rng = np.random.default_rng(0)
+    # rows out of time order, variables out of name order
+    table = xr.Dataset(
+        {
+            'TIME': (('obs',), rng.uniform(24472, 24482, 20), {'units': 'days since 1950-01-01'}),
+            'Temperature [degree_Celsius]': (('obs',), rng.uniform(2, 30, 20).astype('float32')),
+            'Latitude': (('obs',), rng.uniform(7.9, 8.9, 20)),
+            'Depth [meter]': (('obs',), rng.uniform(0, 2000, 20).astype('float32')),
+        },
+        attrs={'title': 'Beacon query result'},
+    )
+    source = tmp_path / 'beacon_argo.nc'
+    table.to_netcdf(source)
+    with xr.open_dataset(source) as original:
+        original = original.load()
+
+    store = tmp_path / 'beacon.zarr'
+    compaction.compact_table(store, 'beacon_argo.nc', source, 'TIME')
+    read = compaction.read_table(store, 'beacon_argo.nc')
+    xr.testing.assert_identical(read.load(), original)
+    assert list(read.variables) == list(original.variables)
@@ -0,0 +1,69 @@
+import threading
+
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('h5netcdf')
+
+import udal.specification as udal
+
+from fairease.udal.udal import UDAL
+from fairease.udal.broker import Broker
+from fairease.udal.namedqueries import QUERY_REGISTRY
+from fairease.udal.registry import register_broker
+from fairease.udal.result import Result
+from fairease.udal.server import make_server
+
+
+QUERY = 'urn:fairease.eu:argo:data'
+
+
+def profile(cycle: int) -> xr.Dataset:
+    return xr.Dataset({
+        'CYCLE_NUMBER': (('N_PROF',), np.array([cycle], dtype='int32')),
+        'PLATFORM_NUMBER': (('N_PROF',), np.array([b'1901    '], dtype='S8')),
+        'PRES': (('N_PROF', 'N_LEVELS'), np.arange(4, dtype='float32')[np.newaxis, :] * cycle),
+    })
+
+
+class DatasetBroker(Broker):
+    """Returns one profile, or a list of them with the `profiles` layout."""
+
+    _name = 'datasets'
+
+    def __init__(self, config: udal.Config | None = None):
+        pass
+
+    @property
+    def queries(self):
+        return {QUERY: QUERY_REGISTRY[QUERY]}
+
+    def execute(self, name, params=None):
+        if (params or {}).get('layout') == 'profiles':
+            return Result(QUERY_REGISTRY[name], [profile(1), profile(2)])
+        return Result(QUERY_REGISTRY[name], profile(1))
+
+
+@pytest.fixture
+def server():
+    register_broker('test:datasets', DatasetBroker)
+    server = make_server(udal.Config(), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'udal+http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_dataset_round_trip(server):
+    result = UDAL(f'{server}?broker=test:datasets').execute(QUERY, {})
+    xr.testing.assert_identical(result.data(), profile(1))
+
+
+def test_list_round_trip(server):
+    result = UDAL(f'{server}?broker=test:datasets').execute(QUERY, {'layout': 'profiles'})
+    data = result.data()
+    assert len(data) == 2
+    for read, original in zip(data, [profile(1), profile(2)]):
+        xr.testing.assert_identical(read, original)